@@ -0,0 +1,460 @@
+######################################################################
+#
+# File: bench.py
+#
+# Copyright 2011 by Brian Beach and Jaran Charumilind
+#
+# This software is licensed under the MIT license.
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+######################################################################
+
+"""
+Benchmarks for the hot paths in tinymock.  To run them:
+
+    python bench.py
+
+Every result is a cost per operation, so smaller is better.  To
+compare two revisions, save the results of one as JSON, and then
+compare the other against it:
+
+    python bench.py --json before.json
+    python bench.py --compare before.json
+
+With --compare, the exit status is 1 if any result got worse by more
+than the threshold (20% by default).
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from tinymock.impl import (
+    CallContext, ExpectationScript, MockException, MockFunction, MockObject,
+    Patch, PatchSet, UNORDERED, spec_object
+    )
+
+# How many times each timing is repeated.  The fastest one is reported,
+# since the others were slowed down by something else on the machine.
+REPEAT = 5
+
+def best_time(setup, run, count):
+    """
+    Calls setup() to make the state for one trial, and then times
+    run(state).  run is expected to do count operations.  Returns the
+    best time per operation, in nanoseconds.
+    """
+    best = None
+    for trial in range(REPEAT):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e9 / count
+
+def queued_fcn(count, args, kwargs):
+    """
+    Makes a mock function with count identical calls expected.
+    """
+    context = CallContext()
+    fcn = MockFunction(context, 'fcn')
+    for i in range(count):
+        fcn.expect(*args, **kwargs).returns(i)
+    return fcn
+
+def bench_dispatch_depth():
+    """
+    Queues up N expected calls and then makes them all.  The cost
+    per call should stay flat as N grows.
+    """
+    for depth in [1000, 10000, 100000]:
+        def run(fcn):
+            for i in range(depth):
+                fcn(i)
+        def setup():
+            context = CallContext()
+            fcn = MockFunction(context, 'fcn')
+            for i in range(depth):
+                fcn.expect(i).returns(i)
+            return fcn
+        yield ('dispatch.depth_%d' % depth, best_time(setup, run, depth),
+               'ns/call')
+
+def bench_unordered():
+    """
+    Expects N calls with different keys in an UNORDERED context, and
+    makes them in reverse order.  The cost per call should stay flat
+    as N grows.  Calls with a dict argument can't be looked up by
+    their arguments, but they shouldn't cost more than checking the
+    calls that can't.
+    """
+    for count in [1000, 50000]:
+        def run(fcn):
+            for i in range(count - 1, -1, -1):
+                fcn('key', i)
+        def setup():
+            fcn = MockFunction(CallContext(ordering = UNORDERED), 'fcn')
+            for i in range(count):
+                fcn.expect('key', i).returns(i)
+            return fcn
+        yield ('unordered.keys_%d' % count, best_time(setup, run, count),
+               'ns/call')
+    for count in [1000, 16000]:
+        def run(fcn):
+            for i in range(count):
+                fcn('key', {'value': i})
+        def setup():
+            fcn = MockFunction(CallContext(ordering = UNORDERED), 'fcn')
+            for i in range(count):
+                fcn.expect('key%d' % i).returns(i)
+            for i in range(count):
+                fcn.expect('key', {'value': i})
+            return fcn
+        yield ('unordered.unhashable_%d' % count,
+               best_time(setup, run, count), 'ns/call')
+
+def bench_ordering_groups():
+    """
+    Expects open, then N reads in any order, then close, and makes
+    the reads in reverse order.  The cost per call should stay flat
+    as N grows.
+    """
+    for count in [1000, 50000]:
+        def run(fcns):
+            (open_, read, close) = fcns
+            open_()
+            for i in range(count - 1, -1, -1):
+                read(i)
+            close()
+        def setup():
+            context = CallContext(ordering = UNORDERED)
+            fcns = [MockFunction(context, name)
+                    for name in ['open', 'read', 'close']]
+            (open_, read, close) = fcns
+            with context.in_order():
+                open_.expect()
+                with context.any_order():
+                    for i in range(count):
+                        read.expect(i)
+                close.expect()
+            return fcns
+        yield ('ordering_groups.reads_%d' % count,
+               best_time(setup, run, count), 'ns/call')
+
+def bench_dispatch_args():
+    """
+    Measures matching calls with different numbers of arguments.
+    """
+    count = 100000
+    cases = [
+        ('none', (), {}),
+        ('args_1', (1,), {}),
+        ('args_5', (1, 2, 3, 4, 5), {}),
+        ('args_2_kwargs_1', (1, 'two'), dict(three = 3)),
+        ('kwargs_3', (), dict(a = 1, b = 2, c = 3))
+        ]
+    for (name, args, kwargs) in cases:
+        def run(fcn):
+            for i in range(count):
+                fcn(*args, **kwargs)
+        def setup():
+            return queued_fcn(count, args, kwargs)
+        yield ('dispatch.%s' % name, best_time(setup, run, count), 'ns/call')
+
+def bench_setup():
+    """
+    Measures setting up expected calls with expect().returns().
+    """
+    count = 100000
+    def run(fcn):
+        for i in range(count):
+            fcn.expect(i, 'x').returns(i)
+    def setup():
+        return MockFunction(CallContext(), 'fcn')
+    yield ('setup.expect_returns', best_time(setup, run, count), 'ns/call')
+
+def bench_script():
+    """
+    Measures binding a prebuilt script of expected calls to a new
+    context, and then making the calls, compared with setting up the
+    same calls with expect().returns() in each test.
+    """
+    count = 5000
+    script = ExpectationScript()
+    fcn = script.mock_fcn('fcn')
+    for i in range(count):
+        fcn.expect(i).returns(i)
+    def run(context):
+        script.bind(context)
+    yield ('script.bind_%d' % count, best_time(CallContext, run, 1),
+           'ns/bind')
+    def run(context):
+        script.bind(context)
+        for i in range(count):
+            fcn(i)
+    yield ('script.bind_and_call', best_time(CallContext, run, count),
+           'ns/call')
+    def run(context):
+        fcn = MockFunction(context, 'fcn')
+        for i in range(count):
+            fcn.expect(i).returns(i)
+        for i in range(count):
+            fcn(i)
+    yield ('script.expect_and_call', best_time(CallContext, run, count),
+           'ns/call')
+
+def bench_expectation_memory():
+    """
+    Reports how much memory each queued expectation takes.
+    """
+    count = 100000
+    context = CallContext()
+    fcn = MockFunction(context, 'fcn')
+    args = [(i, 'x') for i in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for (a, b) in args:
+        fcn.expect(a, b)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    yield ('memory.expectation', float(after - before) / count, 'bytes')
+
+def bench_mock_object():
+    """
+    Measures making mock objects, and calling an operator on one.
+    """
+    count = 20000
+    def run(context):
+        for i in range(count):
+            MockObject(context, 'obj', ['foo', '__add__'], bar = 1)
+    yield ('mock_object.create', best_time(CallContext, run, count),
+           'ns/object')
+    def run(context):
+        for i in range(count):
+            MockObject(context, 'obj', ['__add__', '__len__'])
+    yield ('mock_object.create_builtins', best_time(CallContext, run, count),
+           'ns/object')
+    def run(obj):
+        for i in range(count):
+            obj + 1
+    def setup():
+        context = CallContext()
+        obj = MockObject(context, 'obj', ['__add__'])
+        obj.__add__.expect(1).returns(2).times(count)
+        return obj
+    yield ('mock_object.operator', best_time(setup, run, count), 'ns/call')
+
+class Spec(object):
+
+    def get(self, key, default = None):
+        pass
+
+    def put(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def __len__(self):
+        return 0
+
+def bench_spec_object():
+    """
+    Measures making mock objects from a spec class, and calling a
+    method whose signature is checked.
+    """
+    count = 20000
+    def run(context):
+        for i in range(count):
+            spec_object(context, 'obj', Spec)
+    yield ('spec_object.create', best_time(CallContext, run, count),
+           'ns/object')
+    def run(obj):
+        for i in range(count):
+            obj.get(1)
+    def setup():
+        obj = spec_object(CallContext(), 'obj', Spec)
+        obj.get.expect(1).returns(2).times(count)
+        return obj
+    yield ('spec_object.call', best_time(setup, run, count), 'ns/call')
+
+class Target(object):
+    pass
+
+def bench_patch():
+    """
+    Measures entering and leaving patches.
+    """
+    count = 20000
+    target = Target()
+    target.a = 1
+    def run(patch):
+        for i in range(count):
+            with patch:
+                pass
+    def setup():
+        return Patch(target, 'a', 2)
+    yield ('patch.enter_exit', best_time(setup, run, count), 'ns/patch')
+    def setup():
+        return PatchSet(*[(target, 'f%d' % i, i) for i in range(10)])
+    yield ('patch_set_10.enter_exit', best_time(setup, run, count),
+           'ns/patch_set')
+
+def bench_failure_message():
+    """
+    Measures making and rendering the message for a failure with a
+    deep queue of expected calls.
+    """
+    count = 100
+    def run(fcns):
+        for fcn in fcns:
+            try:
+                fcn('wrong')
+            except MockException as e:
+                str(e)
+    def setup():
+        return [queued_fcn(1000, ('x' * 1000,), {}) for i in range(count)]
+    yield ('failure.render', best_time(setup, run, count), 'ns/failure')
+
+BENCHMARKS = [
+    bench_dispatch_depth,
+    bench_dispatch_args,
+    bench_unordered,
+    bench_ordering_groups,
+    bench_setup,
+    bench_script,
+    bench_expectation_memory,
+    bench_mock_object,
+    bench_spec_object,
+    bench_patch,
+    bench_failure_message
+    ]
+
+def git_revision():
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr = subprocess.DEVNULL
+            )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('ascii').strip()
+
+def benchmark_name(benchmark):
+    """
+    Returns the name of a benchmark function without its bench_
+    prefix, which is how --filter names it.
+    """
+    return benchmark.__name__[len('bench_'):]
+
+def run_benchmarks(names):
+    """
+    Runs the benchmark functions with the given names, or all of them
+    if names is None.
+    """
+    results = {}
+    for benchmark in BENCHMARKS:
+        if names is not None and benchmark_name(benchmark) not in names:
+            continue
+        for (name, value, unit) in benchmark():
+            results[name] = dict(value = value, unit = unit)
+            print('%-28s %12.1f %s' % (name, value, unit))
+            sys.stdout.flush()
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Prints how each result changed from the baseline, and returns the
+    names of the ones that got worse by more than the threshold.
+    """
+    regressions = []
+    print('')
+    print('%-28s %12s %12s %8s' % ('benchmark', 'before', 'after', 'change'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['value']
+        after = results[name]['value']
+        if before == 0 and 0 < after:
+            # There's no relative change from nothing, but anything
+            # more than nothing is worse.
+            regressions.append(name)
+            print('%-28s %12.1f %12.1f %8s  REGRESSION' %
+                  (name, before, after, 'inf'))
+            continue
+        if before == 0:
+            change = 0.0
+        else:
+            change = (after - before) / before
+        flag = ''
+        if threshold < change:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-28s %12.1f %12.1f %+7.1f%%%s' %
+              (name, before, after, change * 100, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = 'tinymock benchmarks')
+    parser.add_argument('--json', help = 'write the results to this file')
+    parser.add_argument(
+        '--compare',
+        help = 'compare with results saved by --json'
+        )
+    parser.add_argument(
+        '--threshold', type = float, default = 0.2,
+        help = 'largest slowdown allowed by --compare'
+        )
+    parser.add_argument(
+        '--filter',
+        action = 'append',
+        choices = [benchmark_name(benchmark) for benchmark in BENCHMARKS],
+        help = 'only run this benchmark function (can be repeated)'
+        )
+    options = parser.parse_args()
+    results = run_benchmarks(options.filter)
+    if options.json is not None:
+        with open(options.json, 'w') as f:
+            json.dump(
+                dict(
+                    revision = git_revision(),
+                    python = platform.python_version(),
+                    results = results
+                    ),
+                f,
+                indent = 2,
+                sort_keys = True
+                )
+    if options.compare is not None:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        if len(compare(results, baseline, options.threshold)) != 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -66,6 +66,38 @@ after the mock function has been called::
             fcn(2, "hello")
             self.assertEquals("hello", any_value.value)
 
+Other kinds of expected values are available for when an exact value
+is too strict.  Predicate matches any value for which a function
+returns true, InstanceOf matches values of the given types, and Approx
+matches numbers that are close to the expected one::
+
+    class TestIt(tinymock.TestCase):
+        def test_matchers(self):
+            fcn = self.mock_fcn("fcn")
+            fcn.expect(tinymock.InstanceOf(str), tinymock.Approx(0.3))
+            fcn("hello", 0.1 + 0.2)
+
+For large binary data, BufferEqual matches anything that supports the
+buffer protocol (bytes, bytearray, memoryview, array.array) holding
+the same bytes, and ArrayEqual and ArrayApprox match array-like
+objects, like NumPy arrays, with one vectorized comparison.  When they
+don't match, the failure message says where the data first differs,
+instead of showing all of it.  NumPy arrays passed straight to expect
+are compared with ArrayEqual::
+
+    class TestIt(tinymock.TestCase):
+        def test_write(self):
+            write = self.mock_fcn("write")
+            write.expect(tinymock.BufferEqual(expected_image))
+            save = self.mock_fcn("save")
+            save.expect(tinymock.ArrayApprox(expected_pixels, abs_tol = 1e-6))
+            function_that_writes_and_saves_an_image()
+
+You can make your own by subclassing Matcher and implementing its
+matches method.  Expected calls whose arguments are all plain values
+are compared in one step, so matchers only cost anything where they
+are used.
+
 A return value can be specified by calling the returns method on the
 mock function object after a call.  Here is an example that calls a
 function that expects no arguments and returns 2::
@@ -75,6 +107,18 @@ function that expects no arguments and returns 2::
             fcn = self.mock_fcn('fcn').expect().returns(2)
             self.assertEquals(2, fcn())
 
+When the return value is big, or depends on the arguments, it can be
+made when the call happens.  returns_from takes the next value from
+an iterator each time the call is matched, and returns_computed calls
+a function with the actual arguments::
+
+    class TestIt(tinymock.TestCase):
+        def test_pages(self):
+            fetch = self.mock_fcn("fetch")
+            fetch.expect(tinymock.AnyValue()).returns_from(make_pages()).times(1000)
+            double = self.mock_fcn("double")
+            double.expect(tinymock.AnyValue()).returns_computed(lambda x: 2 * x)
+
 Upon creation, a MockFunction does not expect any calls.  You use the
 expect method for each time you expect the method to be called.
 Here is a test case that directly calls a mock function three times,
@@ -89,6 +133,17 @@ each time with different arguments and a different return value::
             self.assertEquals(1, fcn())
             self.assertEquals(2, fcn("a"))
             self.assertEquals(3, fcn("b", "c"))
+
+When the same call is expected many times in a row, say so with times
+instead of repeating the expect.  at_least and any_number allow an
+open-ended number of calls.  However many times the call happens, it
+is stored once, with a counter::
+
+    class TestIt(tinymock.TestCase):
+        def test_repeated(self):
+            fcn = self.mock_fcn("fcn").expect(1).returns(2).times(10000)
+            poll = self.mock_fcn("poll").expect().returns(None).at_least(1)
+            function_that_calls_fcn_10000_times_then_polls()
                      
 Making mock objects is straightforward.  The MockObject class is
 simply a container for the members of the object, which can be set
@@ -123,6 +178,10 @@ just like normal functions::
             obj.__add__.expect(1).returns(3)
             self.assertEquals(3, obj + 1)
 
+Only the built-in methods that you mock are defined on a mock object,
+so protocol checks like hasattr(obj, '__len__') are false for the
+others.
+
 Because the pattern above is very common pattern, there's a shorter
 way of saying it.  The mock_obj method takes an optional parameter
 that is a list of methods to define, so the test above can be written
@@ -134,6 +193,21 @@ like this:
             obj.__add__.expect(1).returns(3)
             self.assertEquals(3, obj + 1)
 
+Mocks that accept any arguments can hide a call that the real object
+would reject.  mock_spec makes a mock object from a real class or
+module, with a mock function for each of its methods or functions.
+Expected calls and actual calls are both checked against the real
+signatures, so a test that passes the wrong arguments fails::
+
+    class TestIt(tinymock.TestCase):
+        def test_deposit(self):
+            account = self.mock_spec("account", Account)
+            account.deposit.expect(10, memo = "pay")
+            function_that_deposits(account)
+
+The class or module is only inspected the first time it is used as a
+spec, so making lots of mocks from it stays cheap.
+
 A patch can be used to replace a field in another module or object for
 the duration of a test.  The patch method returns an object used as
 the context for a with statement to make the replacement, and then to
@@ -161,7 +235,203 @@ If you have multiple calls to patch, you can use a PatchSet::
                 )
             with patch_set:
                 function_that_should_sleep_10_seconds_and_getpid()
+
+When every test in a class patches the same fields, list them in
+class_patches instead.  They are patched once before the first test
+in the class runs, and put back after the last one::
+
+    class TestIt(tinymock.TestCase):
+        class_patches = [
+            (config, "DEBUG", True),
+            (os, "getpid", lambda: 1)
+            ]
+
+module_patches does the same for all of the tests in a module::
+
+    setUpModule, tearDownModule = tinymock.module_patches(
+        (config, "DEBUG", True)
+        )
+
+Code that retries, backs off, or times out needs time to actually pass
+while it runs.  A virtual clock replaces time.sleep, time.time,
+time.monotonic, and the other clock functions in the time module with
+a simulated clock.  Sleeping moves the simulated clock forward without
+waiting, so the test runs instantly, and the sleeps are recorded::
+
+    class TestIt(tinymock.TestCase):
+        def test_backoff(self):
+            with self.virtual_clock() as clock:
+                function_that_retries_with_backoff()
+            self.assertEquals([1, 2, 4], clock.sleeps)
+
+If the code under test did "from time import sleep", pass its module
+to virtual_clock so that its copy is replaced too.
+
+Writing out the expected calls by hand is impractical for a chatty
+dependency.  Instead, wrap the real function with record to save every
+call it gets in a cassette file, and later replay the file with
+expect_cassette.  The cassette is read one call at a time as the calls
+are made, so even a huge one doesn't have to fit in memory::
+
+    class TestIt(tinymock.TestCase):
+        def test_make_cassette(self):
+            client.get = self.record(real_client.get, "get.cassette")
+            function_that_calls_get_a_lot()
+
+        def test_replay(self):
+            get = self.mock_fcn("client.get").expect_cassette("get.cassette")
+            with self.patch(client, "get", get):
+                function_that_calls_get_a_lot()
+
+Calls can also be scripted by a generator, with expect_stream.  The
+generator yields a Call for each expected call, and is only read as
+the calls are made, so it can go on for millions of calls, or
+forever.  If a call doesn't match, the failure message shows where
+the stream was, with a few of the calls before it and the one after::
+
+    class TestIt(tinymock.TestCase):
+        def test_poller(self):
+            def messages():
+                for i in itertools.count():
+                    yield tinymock.Call(timeout = 1).returns("message %d" % i)
+            poll = self.mock_fcn("queue.poll").expect_stream(messages())
+            function_that_polls_a_lot(poll)
+
+A stream that isn't used up by the end of the test fails it, the same
+as any other expected call that wasn't made.
+
+To mock an "async def" function, use mock_async_fcn.  The call is
+checked when it is made, and returns a coroutine that produces the
+return value or raises the exception when awaited.  The delays method
+makes the await take simulated time.  The run_async method runs a
+coroutine on an event loop with a virtual clock, so that delays,
+sleeps, and timeouts finish instantly and always in the same order::
+
+    class TestIt(tinymock.TestCase):
+        def test_fetch(self):
+            fetch = self.mock_async_fcn("fetch")
+            fetch.expect("a").returns(1).delays(5)
+            fetch.expect("b").returns(2).delays(1)
+            self.assertEquals([1, 2], self.run_async(fetch_all(fetch)))
+
+When many tests start with the same long series of calls, build it
+once as an ExpectationScript, and bind it at the start of each test.
+Binding doesn't copy the calls (except with UNORDERED, described
+below), so it is cheap however long the script is, and each test
+still gets its own AnyValue captures::
+
+    PRELUDE = tinymock.ExpectationScript("prelude")
+    connect = PRELUDE.mock_fcn("connect")
+    token = tinymock.AnyValue()
+    connect.expect("host", token).returns("conn")
+
+    class TestIt(tinymock.TestCase):
+        def test_query(self):
+            binding = self.bind_script(PRELUDE)
+            connect.expect("query").returns([])
+            function_that_connects_and_queries(connect)
+            self.assertEquals("secret", binding.value(token))
+
+By default, the expected calls to all of the mock functions in a test
+have to happen in exactly the order they were expected.  When the
+code under test calls several mocks in an order that isn't
+deterministic, set call_ordering on the test case.  PER_FUNCTION
+checks only the order of the calls to each mock function, and
+UNORDERED accepts the expected calls to a function in any order::
+
+    class TestIt(tinymock.TestCase):
+        call_ordering = tinymock.PER_FUNCTION
+
+        def test_worker(self):
+            get = self.mock_fcn("cache.get").expect("k").returns(None)
+            incr = self.mock_fcn("metrics.incr").expect("miss")
+            run_worker_that_calls_incr_and_get_in_any_order()
+
+With UNORDERED, expected calls whose arguments are plain hashable
+values are looked up by their arguments, so a mock with thousands of
+different expected calls is as quick to call as one with a few.
+The calls from a cassette or a stream still have to happen in the
+order they are read, but the calls from an ExpectationScript can
+happen in any order, as if they had been expected one at a time.
+
+Between the two extremes, UNORDERED tests can say which calls have to
+come before which others.  Calls expected inside a with
+self.in_order() block have to happen in order, and calls inside a
+with self.any_order() block can happen in any order.  The blocks can
+be nested, so "open first, then all of the reads in any order, then
+close" looks like this::
+
+    class TestIt(tinymock.TestCase):
+        call_ordering = tinymock.UNORDERED
+
+        def test_reader(self):
+            with self.in_order():
+                open_file.expect("f")
+                with self.any_order():
+                    for i in range(1000):
+                        read.expect(i)
+                close_file.expect("f")
+            function_that_reads_in_parallel()
+
+A call that comes too soon fails with a message saying which call it
+had to wait for.  A repeated call with no upper limit, from at_least
+or any_number, lets the calls after it go ahead once it has been made
+enough times, and can't be made again once one of them has happened.
+
+When a test fails, the message lists all of the calls that have been
+completed so far.  A test that makes millions of calls can keep memory
+use constant by setting call_history_size, which keeps just the most
+recent calls for the message (or, when it is 0, only a count)::
+
+    class TestIt(tinymock.TestCase):
+        call_history_size = 100
+
+The history holds on to the arguments of every call, so a test that
+passes large buffers or lists around keeps all of them alive until it
+ends.  Set fingerprint_call_history to store a short description of
+each call instead, where a large string, buffer, or builtin container
+shows up as its type, length, checksum, and the start of its repr.
+The arguments themselves are let go as soon as the call is matched.  You can get the same
+description of a value with tinymock.fingerprint::
+
+    class TestIt(tinymock.TestCase):
+        fingerprint_call_history = True
+
+If the code under test calls mock functions from worker threads, set
+thread_safe_calls.  With PER_FUNCTION or UNORDERED ordering, each mock
+function has its own lock, so threads using different mocks don't get
+in each other's way.  A failure on a worker thread is raised again in
+tearDown, even if the worker caught it::
+
+    class TestIt(tinymock.TestCase):
+        call_ordering = tinymock.UNORDERED
+        thread_safe_calls = True
+
+When a test is slow, set collect_call_statistics to find out how much
+of the time goes into the mocks.  For each mock function name, the
+statistics count the calls, matches, and mismatches, and add up the
+time spent matching them.  They are written to stderr at the end of
+the test, or you can look at them with call_statistics::
+
+    class TestIt(tinymock.TestCase):
+        collect_call_statistics = True
+
+        def test_slow(self):
+            function_that_calls_lots_of_mocks()
+            print(self.call_statistics().most_called(3))
+
+Collecting statistics costs nothing when it is turned off.
 """
 
 from .impl import TestCase
+from .impl import module_patches
 from .impl import AnyValue
+from .impl import Matcher, Predicate, InstanceOf, Approx
+from .impl import BufferEqual, ArrayEqual, ArrayApprox
+from .impl import VirtualClock
+from .impl import Recorder
+from .impl import Call
+from .impl import fingerprint
+from .impl import ExpectationScript
+from .impl import AsyncMockFunction, VirtualTimeEventLoop
+from .impl import ORDERED, PER_FUNCTION, UNORDERED
@@ -28,39 +28,686 @@
 #
 ######################################################################
 
+import array
+import asyncio
+import bisect
+import collections
+import hashlib
+import heapq
+import importlib.util
+import inspect
+import itertools
+import pickle
+import reprlib
+import selectors
+import sys
+import threading
+import time
 import unittest
+import weakref
+import zlib
 
 class MockException(Exception):
 
     """
     Exception class raised when errors are detected in mock functions.
+
+    The full text of a failure can be large, so it may be supplied as
+    a report object whose render() method is only called the first
+    time the exception is displayed.
+    """
+
+    def __init__(self, message, report = None):
+        super(MockException, self).__init__(message)
+        self._report = report
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            if self._report is None:
+                self._text = super(MockException, self).__str__()
+            else:
+                self._text = self._report.render()
+                self._report = None
+        return self._text
+
+    @property
+    def message(self):
+        return str(self)
+
+
+# The longest repr of one value shown in a failure message.
+MAX_REPR_LENGTH = 200
+
+# The most completed calls, and the most expected calls, listed in a
+# failure message.
+MAX_REPORTED_CALLS = 100
+
+# How many calls before the current position in a stream of expected
+# calls are shown in a failure message.
+STREAM_WINDOW = 5
+
+class _ShortRepr(reprlib.Repr):
+
+    """
+    A repr that keeps failure messages readable when arguments are
+    huge: long strings, byte strings, and containers are cut short
+    without building the repr of the whole thing first.
+    """
+
+    def __init__(self):
+        reprlib.Repr.__init__(self)
+        self.maxlevel = 6
+        self.maxtuple = self.maxlist = self.maxarray = 20
+        self.maxdict = self.maxset = self.maxfrozenset = self.maxdeque = 20
+        self.maxstring = self.maxother = self.maxlong = MAX_REPR_LENGTH
+
+    def repr_bytes(self, value, level):
+        if len(value) <= self.maxstring:
+            return repr(value)
+        return '%s... (%d bytes)' % (repr(value[:self.maxstring]), len(value))
+
+    repr_bytearray = repr_bytes
+
+short_repr = _ShortRepr().repr
+
+# Values longer than this are fingerprinted, rather than kept, in the
+# call history of a context that fingerprints its history.
+FINGERPRINT_MIN_LENGTH = 64
+
+# How much of the repr of a value a fingerprint keeps.
+FINGERPRINT_PREFIX_LENGTH = 40
+
+# The types that fingerprint takes the length of.  Their len() can't
+# run user code, like a mocked __len__, in the middle of a match.
+_BUFFER_TYPES = (bytes, bytearray, memoryview, array.array)
+_SIZED_TYPES = _BUFFER_TYPES + (str, list, tuple, dict, set, frozenset)
+
+def fingerprint(value):
+    """
+    Returns a short string standing in for a value in the call
+    history, so that the value itself doesn't have to be kept.  Large
+    values get their type, length, a hash (a CRC-32 of the bytes, for
+    buffers), and the start of their repr.  Other values just get
+    their short repr.
+
+    Only strings, buffers, and the builtin containers count as large,
+    because asking anything else for its length or hash could call a
+    mocked method, like __len__ on a MockObject.
+    """
+    if not isinstance(value, _SIZED_TYPES):
+        return short_repr(value)
+    try:
+        length = len(value)
+    except Exception:
+        return short_repr(value)
+    if length <= FINGERPRINT_MIN_LENGTH:
+        return short_repr(value)
+    digest = ''
+    try:
+        if isinstance(value, _BUFFER_TYPES):
+            digest = ' crc32=%08x' % zlib.crc32(memoryview(value))
+        elif isinstance(value, str):
+            digest = ' hash=%016x' % (hash(value) & 0xffffffffffffffff)
+    except Exception:
+        pass
+    return '<{} len={:,}{} {}...>'.format(
+        type(value).__name__, length, digest,
+        short_repr(value)[:FINGERPRINT_PREFIX_LENGTH]
+        )
+
+
+class Matcher(object):
+
+    """
+    Base class for objects that can be passed in as "expected" values
+    and decide for themselves which actual values match.  Subclasses
+    implement matches(), and should implement __repr__ so that failure
+    messages are readable.
     """
 
+    __slots__ = ()
+
+    def matches(self, value):
+        """
+        Returns True if the value passed in to a mock function is
+        acceptable.
+        """
+        raise NotImplementedError()
+
+    def describe_mismatch(self, value):
+        """
+        Returns a short description of how a value that didn't match
+        differs from what was expected, or None if there is nothing
+        more to say than the repr of the two.  Only used for failure
+        messages.
+        """
+        return None
+
 
-class AnyValue(object):
+class AnyValue(Matcher):
     """
     An object that can be passed in as an "expected" value that will match
     anything.  After matching, the "value" attribute will be equal to what was
     actually passed in
     """
+
+    __slots__ = ('value',)
+
     def __init__(self):
         self.value = None
 
+    def matches(self, value):
+        self.value = value
+        return True
+
+    def __repr__(self):
+        return '<AnyValue>'
+
+
+class Predicate(Matcher):
+
+    """
+    Matches any value for which the given function returns true.
+    """
+
+    __slots__ = ('_fcn', '_description')
+
+    def __init__(self, fcn, description = None):
+        self._fcn = fcn
+        self._description = description or getattr(fcn, '__name__', repr(fcn))
+
+    def matches(self, value):
+        return bool(self._fcn(value))
+
+    def __repr__(self):
+        return '<Predicate %s>' % self._description
+
+
+class InstanceOf(Matcher):
+
+    """
+    Matches any value that is an instance of one of the given types.
+    """
+
+    __slots__ = ('_types',)
+
+    def __init__(self, *types):
+        self._types = types
+
+    def matches(self, value):
+        return isinstance(value, self._types)
+
+    def __repr__(self):
+        return '<InstanceOf %s>' % ', '.join(t.__name__ for t in self._types)
+
+
+class Approx(Matcher):
+
+    """
+    Matches numbers close to the expected one: within rel_tol of it,
+    relative to the larger magnitude, or within abs_tol of it.
+    """
+
+    __slots__ = ('_expected', '_rel_tol', '_abs_tol')
+
+    def __init__(self, expected, rel_tol = 1e-9, abs_tol = 0.0):
+        self._expected = expected
+        self._rel_tol = rel_tol
+        self._abs_tol = abs_tol
+
+    def matches(self, value):
+        try:
+            difference = abs(value - self._expected)
+            scale = max(abs(value), abs(self._expected))
+        except TypeError:
+            return False
+        return difference <= max(self._rel_tol * scale, self._abs_tol)
+
+    def __repr__(self):
+        return '<Approx %r>' % (self._expected,)
+
+
+def _plain_equal(expected, value):
+    try:
+        return bool(expected == value)
+    except ValueError:
+        return False
+
+# How many bytes BufferEqual compares at a time.
+BUFFER_CHUNK = 1 << 16
+
+def _byte_view(value):
+    """
+    Returns a memoryview of the bytes of an object that supports the
+    buffer protocol.  Raises TypeError if it doesn't.
+    """
+    view = memoryview(value)
+    if view.ndim == 1 and view.format == 'B':
+        return view
+    if view.c_contiguous:
+        return view.cast('B')
+    return memoryview(view.tobytes())
+
+def _same_bytes(expected, actual):
+    """
+    Returns true if two memoryviews of bytes hold the same bytes.
+    They are compared a chunk at a time, so only a chunk is copied at
+    once.
+    """
+    if len(expected) != len(actual):
+        return False
+    for start in range(0, len(expected), BUFFER_CHUNK):
+        end = start + BUFFER_CHUNK
+        if expected[start:end].tobytes() != actual[start:end].tobytes():
+            return False
+    return True
+
+def _first_difference(expected, actual):
+    """
+    Returns the offset of the first byte where two memoryviews of
+    bytes differ, or None if they are the same.
+    """
+    length = min(len(expected), len(actual))
+    for start in range(0, length, BUFFER_CHUNK):
+        end = min(start + BUFFER_CHUNK, length)
+        if expected[start:end].tobytes() != actual[start:end].tobytes():
+            for i in range(start, end):
+                if expected[i] != actual[i]:
+                    return i
+    if len(expected) != len(actual):
+        return length
+    return None
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+class BufferEqual(Matcher):
+
+    """
+    Matches any object supporting the buffer protocol (bytes,
+    bytearray, memoryview, array.array, and so on) holding the same
+    bytes as the expected one.  Large buffers are compared through
+    memoryviews a chunk at a time, without copying the whole thing,
+    and a failure says where they first differ rather than showing
+    them both.
+    """
+
+    __slots__ = ('_expected', '_digest')
+
+    def __init__(self, expected):
+        _byte_view(expected)
+        self._expected = expected
+        self._digest = None
+
+    def matches(self, value):
+        expected = self._expected
+        if type(value) in (bytes, bytearray) and type(expected) in (bytes, bytearray):
+            return expected == value
+        try:
+            view = _byte_view(value)
+        except TypeError:
+            return False
+        return _same_bytes(_byte_view(expected), view)
+
+    def describe_mismatch(self, value):
+        try:
+            view = _byte_view(value)
+        except TypeError:
+            return 'not a buffer: %s' % short_repr(value)
+        expected = _byte_view(self._expected)
+        offset = _first_difference(expected, view)
+        if offset is None:
+            return None
+        text = 'expected {:,} bytes, got {:,} (sha256 {}); '.format(
+            len(expected), len(view), _digest(view)
+            )
+        if offset == min(len(expected), len(view)):
+            return text + 'same up to the end of the shorter one'
+        return text + 'first difference at offset {:,}: 0x{:02x} != 0x{:02x}'.format(
+            offset, expected[offset], view[offset]
+            )
+
+    def __repr__(self):
+        if self._digest is None:
+            self._digest = _digest(_byte_view(self._expected))
+        return '<BufferEqual {:,} bytes, sha256 {}>'.format(
+            len(_byte_view(self._expected)), self._digest
+            )
+
+class ArrayEqual(Matcher):
+
+    """
+    Matches an array, like a NumPy array, with the same shape and
+    elements as the expected one, compared in one vectorized
+    operation.  The dtypes don't have to be the same.  It doesn't
+    need NumPy itself: it only uses the shape attribute and array
+    operators of the arrays it is given.
+
+    Arrays passed to expect() directly are wrapped in an ArrayEqual,
+    because comparing them with == doesn't give a single answer.
+    """
+
+    __slots__ = ('_expected', '_digest')
+
+    def __init__(self, expected):
+        self._expected = expected
+        self._digest = None
+
+    def _differences(self, value):
+        """
+        Returns an array of the elements that differ, which is true
+        where value differs from the expected array.
+        """
+        return value != self._expected
+
+    def matches(self, value):
+        if getattr(value, 'shape', None) != self._expected.shape:
+            return False
+        try:
+            return not self._differences(value).any()
+        except (AttributeError, TypeError, ValueError):
+            # The elements can't be compared.
+            return False
+
+    def describe_mismatch(self, value):
+        expected = self._expected
+        shape = getattr(value, 'shape', None)
+        if shape != expected.shape:
+            return 'expected shape %s, got %s' % (
+                expected.shape, short_repr(shape)
+                )
+        try:
+            flat = self._differences(value).ravel()
+        except (AttributeError, TypeError, ValueError):
+            return None
+        count = int(flat.sum())
+        if count == 0:
+            return None
+        first = int(flat.argmax())
+        index = []
+        position = first
+        for size in reversed(expected.shape):
+            (position, i) = divmod(position, size)
+            index.insert(0, i)
+        return '{:,} of {:,} elements differ; first at index {}: expected {}, got {}'.format(
+            count, len(flat), tuple(index),
+            short_repr(expected.ravel()[first]),
+            short_repr(value.ravel()[first])
+            )
+
+    def _name(self):
+        return 'ArrayEqual'
+
+    def __repr__(self):
+        if self._digest is None:
+            try:
+                self._digest = _digest(_byte_view(self._expected))
+            except TypeError:
+                self._digest = '?'
+        return '<%s shape %s %s, sha256 %s>' % (
+            self._name(), self._expected.shape,
+            getattr(self._expected, 'dtype', ''), self._digest
+            )
+
+class ArrayApprox(ArrayEqual):
+
+    """
+    Matches an array with the same shape as the expected one, whose
+    elements are all within rel_tol (relative to the expected
+    element) or abs_tol of the expected ones.
+    """
+
+    __slots__ = ('_rel_tol', '_abs_tol')
+
+    def __init__(self, expected, rel_tol = 1e-9, abs_tol = 0.0):
+        super(ArrayApprox, self).__init__(expected)
+        self._rel_tol = rel_tol
+        self._abs_tol = abs_tol
+
+    def _differences(self, value):
+        tolerance = self._abs_tol + self._rel_tol * abs(self._expected)
+        return ~(abs(value - self._expected) <= tolerance)
+
+    def _name(self):
+        return 'ArrayApprox'
+
+def _wrap_arrays(values):
+    """
+    Returns the values with any NumPy arrays in it wrapped in an
+    ArrayEqual.  If NumPy hasn't been imported, there can't be any.
+
+    Every ExpectedCall made from arguments that a test supplied, from
+    expect(), a stream, or a cassette, goes through this.
+    """
+    numpy = sys.modules.get('numpy')
+    if numpy is None:
+        return values
+    ndarray = numpy.ndarray
+    if isinstance(values, dict):
+        if any(isinstance(value, ndarray) for value in values.values()):
+            return dict(
+                (name, ArrayEqual(value) if isinstance(value, ndarray) else value)
+                for (name, value) in values.items()
+                )
+        return values
+    if any(isinstance(value, ndarray) for value in values):
+        return tuple(
+            ArrayEqual(value) if isinstance(value, ndarray) else value
+            for value in values
+            )
+    return values
+
+# Shared by expected calls with no keyword arguments.  Never modified.
+_NO_KWARGS = {}
 
 class ExpectedCall(object):
 
     """
     Container object holding the information about one expected call.
+
+    An expected call can stand for several identical calls: it must be
+    matched at least min_count times, and at most max_count times (None
+    means there is no limit).  call_count is the number of times it has
+    been matched so far.
+
+    The expected arguments are compiled when the call is created: if
+    they are all plain values, an actual call matches when its argument
+    tuple and keyword dict are equal to the expected ones.  Only the
+    positions holding a Matcher need to be checked one at a time.
+
+    Large tests queue up hundreds of thousands of these, so they use
+    __slots__ rather than a __dict__ per instance.
     """
+
+    __slots__ = (
+        'fcn', 'args', 'kwargs', 'return_value', 'exception', 'delay',
+        'min_count', 'max_count', 'call_count',
+        '_arg_matchers', '_kwarg_matchers'
+        )
     
     def __init__(self, fcn, args, kwargs):
         self.fcn = fcn
         self.args = args
-        self.kwargs = kwargs
+        # Most calls have no keyword arguments, and they can all share
+        # one empty dict.
+        self.kwargs = kwargs or _NO_KWARGS
         self.return_value = None
         self.exception = None
+        self.delay = 0
+        self.min_count = 1
+        self.max_count = 1
+        self.call_count = 0
+        # For each position, the Matcher there or None; or just None if
+        # there are no matchers at all.
+        self._arg_matchers = None
+        if any(isinstance(arg, Matcher) for arg in args):
+            self._arg_matchers = tuple(
+                arg if isinstance(arg, Matcher) else None
+                for arg in args
+                )
+        # The names of the keyword arguments that hold matchers, or
+        # None if there aren't any.
+        self._kwarg_matchers = None
+        if any(isinstance(arg, Matcher) for arg in kwargs.values()):
+            self._kwarg_matchers = frozenset(
+                name for (name, arg) in kwargs.items()
+                if isinstance(arg, Matcher)
+                )
+
+    def mismatch(self, args, kwargs):
+        """
+        Returns None if this call matches the arguments, or a
+        description of what didn't match.
+
+        This is on the path of every mock call, so it is careful not
+        to allocate anything when the call matches.
+        """
+        arg_matchers = self._arg_matchers
+        if arg_matchers is None:
+            try:
+                if not self.args == args:
+                    return 'Argument mismatch'
+            except ValueError:
+                # An array compared with something that isn't a
+                # matcher, which can't be turned into one bool.
+                return 'Argument mismatch'
+        else:
+            expected_args = self.args
+            if len(expected_args) != len(args):
+                return 'Argument mismatch'
+            # Every matcher sees its argument, even after a mismatch,
+            # so that AnyValue captures are complete.
+            args_mismatch = False
+            for i in range(len(args)):
+                matcher = arg_matchers[i]
+                if matcher is None:
+                    if not _plain_equal(expected_args[i], args[i]):
+                        args_mismatch = True
+                elif not matcher.matches(args[i]):
+                    args_mismatch = True
+            if args_mismatch:
+                return 'Argument mismatch'
+        kwarg_matchers = self._kwarg_matchers
+        if kwarg_matchers is None:
+            try:
+                if not self.kwargs == kwargs:
+                    return 'Keyword argument mismatch'
+            except ValueError:
+                return 'Keyword argument mismatch'
+        else:
+            expected_kwargs = self.kwargs
+            if len(expected_kwargs) != len(kwargs):
+                return 'Keyword argument mismatch'
+            for name in kwargs:
+                if name not in expected_kwargs:
+                    return 'Keyword argument mismatch'
+            kwargs_mismatch = False
+            for name in kwargs:
+                if name in kwarg_matchers:
+                    if not expected_kwargs[name].matches(kwargs[name]):
+                        kwargs_mismatch = True
+                elif not _plain_equal(expected_kwargs[name], kwargs[name]):
+                    kwargs_mismatch = True
+            if kwargs_mismatch:
+                return 'Keyword argument mismatch'
+        return None
+
+    def is_satisfied(self):
+        return self.min_count <= self.call_count
+
+    def describe_mismatch(self, args, kwargs):
+        """
+        Returns a list of lines from the matchers in this call that
+        can say how their arguments differ from what they expected.
+        This is only used for failure messages.
+        """
+        result = []
+        if self._arg_matchers is not None and len(args) == len(self.args):
+            for (i, matcher) in enumerate(self._arg_matchers):
+                if matcher is not None:
+                    description = matcher.describe_mismatch(args[i])
+                    if description is not None:
+                        result.append('argument %d: %s' % (i, description))
+        if self._kwarg_matchers is not None:
+            for name in sorted(self._kwarg_matchers):
+                if name in kwargs:
+                    matcher = self.kwargs[name]
+                    description = matcher.describe_mismatch(kwargs[name])
+                    if description is not None:
+                        result.append('argument %s: %s' % (name, description))
+        return result
+
+    def has_matchers(self):
+        """
+        Returns true if any of the expected arguments is a Matcher.
+        """
+        return self._arg_matchers is not None or self._kwarg_matchers is not None
+
+    def has_any_value(self):
+        """
+        Returns true if any of the expected arguments is an AnyValue.
+        """
+        return (
+            (self._arg_matchers is not None and
+             any(isinstance(m, AnyValue) for m in self._arg_matchers)) or
+            (self._kwarg_matchers is not None and
+             any(isinstance(self.kwargs[name], AnyValue)
+                 for name in self._kwarg_matchers))
+            )
+
+    def copy(self, any_values):
+        """
+        Returns a new ExpectedCall like this one, that hasn't been
+        called yet.  Each AnyValue in the arguments is replaced by the
+        one it maps to in the dict any_values, which gets a new one
+        the first time each AnyValue is seen.
+        """
+        def replace(arg):
+            if isinstance(arg, AnyValue):
+                new_arg = any_values.get(arg)
+                if new_arg is None:
+                    new_arg = any_values[arg] = AnyValue()
+                return new_arg
+            return arg
+        args = self.args
+        if self._arg_matchers is not None:
+            args = tuple(replace(arg) for arg in args)
+        kwargs = self.kwargs
+        if self._kwarg_matchers is not None:
+            kwargs = dict(
+                (name, replace(arg)) for (name, arg) in kwargs.items()
+                )
+        result = ExpectedCall(self.fcn, args, kwargs)
+        result.return_value = self.return_value
+        result.exception = self.exception
+        result.delay = self.delay
+        result.min_count = self.min_count
+        result.max_count = self.max_count
+        return result
+
+    def _repetition(self, with_count):
+        if self.max_count is None:
+            if self.min_count == 0:
+                text = 'any number of times'
+            else:
+                text = 'at least %d times' % self.min_count
+        else:
+            text = '%d times' % self.max_count
+        if with_count and self.call_count != 0:
+            text += ', called %d' % self.call_count
+        return text
 
     def __str__(self):
+        return self.describe(short_repr, True)
+
+    def describe(self, render, with_count):
+        """
+        Describes this call, using render to turn the arguments and
+        return value into strings.  If with_count is false, the number
+        of times it has been called is left out, because it will
+        change.
+        """
         result = []
         result.append(self.fcn.name)
         result.append('(')
@@ -68,25 +715,40 @@ class ExpectedCall(object):
         for arg in self.args:
             if need_comma:
                 result.append(', ')
-            result.append(repr(arg))
+            result.append(render(arg))
             need_comma = True
         for k in sorted(self.kwargs.keys()):
             if need_comma:
                 result.append(', ')
             result.append(k)
             result.append(' = ')
-            result.append(repr(self.kwargs[k]))
+            result.append(render(self.kwargs[k]))
             need_comma = True
         result.append(')')
         if self.return_value is not None:
             result.append(' returns ')
-            result.append(repr(self.return_value))
+            result.append(render(self.return_value))
         if self.exception is not None:
             result.append(' raises ')
-            result.append(repr(self.exception))
+            result.append(short_repr(self.exception))
+        if self.delay != 0:
+            result.append(' after %gs' % self.delay)
+        if self.min_count != 1 or self.max_count != 1:
+            result.append(' [')
+            result.append(self._repetition(with_count))
+            result.append(']')
         return ''.join(result)
 
 
+# Orderings that a CallContext can enforce.  ORDERED is one global
+# order over every mock function sharing the context.  PER_FUNCTION
+# only requires each mock function's own calls to come in the order
+# they were expected.  UNORDERED accepts the expected calls to each
+# mock function in any order.
+ORDERED = 'ordered'
+PER_FUNCTION = 'per_function'
+UNORDERED = 'unordered'
+
 class CallContext(object):
 
     """
@@ -95,576 +757,4298 @@ class CallContext(object):
     over all the mock functions and objects that use it.
     """
 
-    def __init__(self):
-        self._calls = []
-        self._completed_calls = []
+    def __init__(self, ordering = ORDERED, history_size = None,
+                 thread_safe = False, statistics = False,
+                 fingerprint_history = False):
+        """
+        Creates a new context.  history_size limits how many completed
+        calls are remembered for failure messages: None keeps all of
+        them, a number keeps only that many of the most recent ones,
+        and 0 keeps just a count.
+
+        A thread_safe context can be called from many threads at once.
+        With the ORDERED ordering every call takes one lock, because
+        there is one queue.  With the other orderings each mock
+        function has its own lock, so threads calling different mocks
+        don't wait for each other.  Failures on threads other than the
+        one that made the context are saved, and raised again by
+        check_done.
+
+        If statistics is true, the context counts the calls to each
+        mock function and times how long matching them takes, in a
+        CallStatistics object in the statistics attribute.  Otherwise
+        that attribute is None.
+
+        If fingerprint_history is true, the history of completed calls
+        keeps a description of each call, with large arguments and
+        return values replaced by fingerprints (see fingerprint), so
+        that the context lets go of them as soon as they are matched.
+        The number of times a repeated call was made isn't shown then.
+        """
+        if ordering not in (ORDERED, PER_FUNCTION, UNORDERED):
+            raise ValueError("unknown call ordering: %r" % (ordering,))
+        self._ordering = ordering
+        # Pending calls are consumed from the front, so a deque keeps
+        # each match O(1) no matter how many calls are queued up.
+        self._calls = collections.deque()
+        # When the order is not global, pending calls are indexed by
+        # mock function instead.  Each entry is (sequence_number, call),
+        # and the sequence number keeps failure reports in the order
+        # the calls were expected.
+        self._pending = {}
+        self._sequence = itertools.count()
+        # Ordering groups (see in_order and any_order), which are only
+        # used with UNORDERED.  Calls in a group that can't happen yet
+        # are parked, by function and then sequence number, rather than
+        # pending.  _leaves maps the pending calls in groups to their
+        # _Leaf nodes.
+        self._group = None
+        self._parked = {}
+        self._leaves = {}
+        self._last_call = None
+        self._history_size = history_size
+        self._fingerprint_history = fingerprint_history
+        self._completed_calls = collections.deque(maxlen = history_size)
+        self._completed_count = 0
+        self._thread_safe = thread_safe
+        if thread_safe:
+            # Reentrant, because a thread matching a call may already
+            # hold it (see _lock_for) when it adds or drops a queue of
+            # pending calls, or fails.
+            self._lock = threading.RLock()
+            self._history_lock = threading.Lock()
+            self._function_locks = {}
+            self._owner = threading.current_thread()
+            self._thread_failures = []
+        self.statistics = None
+        if statistics:
+            self.statistics = CallStatistics(thread_safe)
 
     def expect(self, fcn, *args, **kwargs):
-        self._calls.append(ExpectedCall(fcn, args, kwargs))
+        call = ExpectedCall(fcn, _wrap_arrays(args), _wrap_arrays(kwargs))
+        self.expect_call(fcn, call)
+        self._last_call = call
+
+    def expect_call(self, fcn, call):
+        """
+        Adds an ExpectedCall that has already been made, like one from
+        an ExpectationScript, to the given function.
+        """
+        if self._thread_safe:
+            with self._lock_for(fcn, True):
+                self._add_expected(fcn, call)
+        else:
+            self._add_expected(fcn, call)
+
+    def expect_stream(self, fcn, calls, description):
+        """
+        Adds a stream of expected calls to the given function.  calls
+        is an iterator of ExpectedCall objects, which is only read as
+        far as the calls that have been made so far (plus one).  The
+        description is used in failure messages.
+
+        The calls in a stream always happen in the order the iterator
+        produces them, even in an UNORDERED context, because the
+        stream can't look ahead to match a later one.
+        """
+        # Nothing set after this can apply to an earlier call, even if
+        # the stream is empty.
+        self._last_call = None
+        stream = _CallStream(calls, description)
+        if stream.is_exhausted():
+            return
+        if self._thread_safe:
+            with self._lock_for(fcn, True):
+                self._add_expected_stream(fcn, stream)
+        else:
+            self._add_expected_stream(fcn, stream)
+
+    def _add_expected_stream(self, fcn, stream):
+        if self._group is not None:
+            raise Exception("streams can't be used in ordering groups")
+        # The stream's first call goes in front of it, so that there
+        # is always an ExpectedCall to match against.
+        call = stream.next_call()
+        if self._ordering == ORDERED:
+            self._calls.append(call)
+            if not stream.is_exhausted():
+                self._calls.append(stream)
+        else:
+            queue = self._queue_for(fcn)
+            sequence = next(self._sequence)
+            queue.append((sequence, call))
+            if not stream.is_exhausted():
+                queue.append((sequence, stream))
+
+    def _add_expected(self, fcn, call):
+        if self._ordering == ORDERED:
+            self._calls.append(call)
+        elif self._group is not None:
+            leaf = _Leaf(fcn, call, next(self._sequence))
+            self._park(leaf)
+            self._add_node(self._group, leaf)
+        else:
+            queue = self._queue_for(fcn)
+            queue.append((next(self._sequence), call))
+
+    def _queue_for(self, fcn):
+        """
+        Returns the queue of pending calls for a mock function, adding
+        an empty one if there isn't one yet.
+
+        In a thread-safe context, each function's queue is protected
+        by its own lock, but queues are only added to or dropped from
+        the dict of pending calls with the context's lock, so that a
+        failure, which holds that lock, sees all of them at once.
+        """
+        queue = self._pending.get(fcn)
+        if queue is None:
+            if self._thread_safe:
+                with self._lock:
+                    queue = self._pending.setdefault(fcn, self._new_queue())
+            else:
+                queue = self._pending[fcn] = self._new_queue()
+        return queue
+
+    def _new_queue(self):
+        if self._ordering == UNORDERED:
+            return _UnorderedCalls()
+        return collections.deque()
+
+    def _lock_for(self, fcn, create = False):
+        """
+        Returns the lock that protects the pending calls of a mock
+        function in a thread-safe context.
+        """
+        if self._ordering == ORDERED or self._leaves or self._parked:
+            # Calls in ordering groups can make calls to other
+            # functions eligible.
+            return self._lock
+        lock = self._function_locks.get(fcn)
+        if lock is None:
+            if not create:
+                # No calls were ever expected for this function.
+                return self._lock
+            with self._lock:
+                lock = self._function_locks.setdefault(fcn, threading.Lock())
+        return lock
 
     def set_last_return(self, fcn, return_value):
         self._check_last_call(fcn, "return value")
-        self._calls[-1].return_value = return_value
+        self._last_call.return_value = return_value
 
     def set_last_exception(self, fcn, exception):
         self._check_last_call(fcn, "exception")
-        self._calls[-1].exception = exception
+        self._last_call.exception = exception
 
-    def _arg_mismatch(self, expected, arg):
-        if isinstance(expected, AnyValue):
-            expected.value = arg
-            return False
-        return not expected == arg
+    def set_last_delay(self, fcn, delay):
+        self._check_last_call(fcn, "delay")
+        self._last_call.delay = delay
 
-    def call(self, fcn, *args, **kwargs):
-        actual_call = ExpectedCall(fcn, args, kwargs)
-        if len(self._calls) == 0:
-            raise self._make_exception('Unexpected call', actual_call)
-        call = self._calls[0]
-        if call.fcn != fcn:
-            raise self._make_exception('Wrong call', actual_call)
-        args_mismatch = len(call.args) != len(args)
-        if not args_mismatch:
-            for i in range(len(call.args)):
-                if self._arg_mismatch(call.args[i], args[i]):
-                    args_mismatch = True
-        if args_mismatch:
-            raise self._make_exception('Argument mismatch', actual_call)
-        kwargs_mismatch = set(call.kwargs.keys()) != set(kwargs.keys())
-        if not kwargs_mismatch:
-            for prop in kwargs:
-                if self._arg_mismatch(call.kwargs[prop], kwargs[prop]):
-                    kwargs_mismatch = True
-        if kwargs_mismatch:
-            raise self._make_exception('Keyword argument mismatch', actual_call)
-        self._calls.pop(0)
-        self._completed_calls.append(call)
-        if call.exception is not None:
-            raise call.exception
-        else:
-            return call.return_value
+    def set_last_count(self, fcn, min_count, max_count):
+        self._check_last_call(fcn, "repetition count")
+        self._last_call.min_count = min_count
+        self._last_call.max_count = max_count
+        if self._leaves:
+            # A call that doesn't have to happen doesn't hold up the
+            # ones after it.
+            leaf = self._leaves.get(self._last_call)
+            if leaf is not None and not leaf.done and leaf.call.is_satisfied():
+                self._node_done(leaf)
+                self._linger(leaf)
 
-    def check_done(self):
+    def in_order(self):
         """
-        Makes sure that all of the calls that were expected have
-        happened.  Raises an exception if not.
+        Returns a context manager for a with statement.  The calls
+        expected inside it, and the groups nested inside it, have to
+        happen in the order they were expected.  Only allowed with the
+        UNORDERED ordering.
         """
-        if len(self._calls) != 0:
-            raise self._make_exception("Still expecting more function calls", None)
+        return _GroupBuilder(self, True)
 
-    def _make_exception(self, message, actual_call):
-        text = [message]
-        text.append('')
-        text.append('Completed calls:')
-        for call in self._completed_calls:
-            text.append(str(call))
-        text.append('')
-        if actual_call is not None:
-            text.append('Actual call:')
-            text.append(str(actual_call))
-            text.append('')
-        text.append('Expected calls:')
-        for call in self._calls:
-            text.append(str(call))
-        result = MockException('\n'.join(text))
-        self._calls = []
-        self._completed_calls = []
-        return result
+    def any_order(self):
+        """
+        Returns a context manager for a with statement.  The calls
+        expected inside it, and the groups nested inside it, can
+        happen in any order.  Only allowed with the UNORDERED ordering.
+        """
+        return _GroupBuilder(self, False)
 
-    def _check_last_call(self, fcn, reason):
-        if len(self._calls) == 0:
-            raise Exception("no call for which to set " + reason)
-        if fcn != self._calls[-1].fcn:
-            raise Exception(reason + " must be set immediately after expect")
+    def _open_group(self, group):
+        if self._ordering != UNORDERED:
+            raise Exception("ordering groups need the UNORDERED ordering")
+        parent = self._group
+        self._group = group
+        if parent is None:
+            group.active = True
+        else:
+            self._add_node(parent, group)
 
-class MockFunction(object):
+    def _close_group(self, group):
+        if self._group is not group:
+            # The context was reset by a failure inside the group.
+            return
+        self._group = group.parent
+        group.open = False
+        if group.active and not group.done and group.is_complete():
+            self._node_done(group)
 
-    """
-    An object that mimics a function, checking the values passed in as
-    arguments, and returning a value or raising an exception.
-    """
+    def _add_node(self, group, node):
+        node.parent = group
+        node.branch = len(group.children)
+        group.children.append(node)
+        if not group.ordered:
+            group.remaining += 1
+        if group.active and (not group.ordered or node.branch == group.position):
+            if self._activate(node):
+                self._node_done(node)
 
-    def __init__(self, context, name):
+    def _activate(self, node):
         """
-        Creates a new MockFunction with the given name.
+        Makes a node eligible: a call becomes pending, and a group
+        activates the nodes in it that can happen now.  Returns true
+        if the node is already complete, which its parent has to be
+        told about.
         """
-        self._context = context
-        self.name = name
+        node.active = True
+        if type(node) is _Leaf:
+            self._unpark(node)
+            if node.call.is_satisfied():
+                self._linger(node)
+                return True
+            return False
+        if node.ordered:
+            return self._advance(node)
+        for child in node.children:
+            if not child.active and self._activate(child):
+                child.done = True
+                node.remaining -= 1
+        return node.is_complete()
 
-    def expect(self, *args, **kwargs):
+    def _advance(self, group):
         """
-        Adds another expected call to this function, expecting the
-        arguments and keyword argumentsgiven.
-
-        Returns this MockFunction so that a return value can be added
-        on.
+        Activates the next node of an in-order group, and the ones
+        after it if it is already complete.  Returns true if the
+        group is complete.
         """
-        self._context.expect(self, *args, **kwargs)
-        return self
+        children = group.children
+        while group.position < len(children):
+            child = children[group.position]
+            if not self._activate(child):
+                return False
+            child.done = True
+            group.position += 1
+        return not group.open
 
-    def returns(self, return_value):
+    def _node_done(self, node):
         """
-        Specifies the value to be returned.  Returns this MockFunction
-        object so that another call can be chained on.
+        Called when a node has been completed, to let the nodes after
+        it happen.
         """
-        self._context.set_last_return(self, return_value)
-        return self
+        while True:
+            node.done = True
+            group = node.parent
+            if group is None:
+                return
+            if group.ordered:
+                group.position += 1
+                if not self._advance(group):
+                    return
+            else:
+                group.remaining -= 1
+                if not group.is_complete():
+                    return
+            node = group
 
-    def raises(self, exception):
+    def _linger(self, leaf):
         """
-        Specifies an exception to be raised in response to the current
-        call.
+        Notes that a call is done but still pending, in each in-order
+        group it is in, so that it can be retired when a call after it
+        happens.
+        """
+        node = leaf
+        while node.parent is not None:
+            group = node.parent
+            if group.ordered:
+                group.lingering.append((node.branch, leaf))
+            node = group
 
-        Returns this MockFunction so another call can be chained on.
+    def _retire_before(self, leaf):
         """
-        self._context.set_last_exception(self, exception)
-        return self
+        Called when the call for a leaf happens.  Stops expecting the
+        lingering calls that come before it in the in-order groups it
+        is in, just like a satisfied repeated call steps aside in an
+        ORDERED context.
+        """
+        node = leaf
+        while node.parent is not None:
+            group = node.parent
+            if group.ordered and group.lingering:
+                still_lingering = []
+                for (branch, earlier) in group.lingering:
+                    if branch < node.branch:
+                        self._retire(earlier)
+                    else:
+                        still_lingering.append((branch, earlier))
+                group.lingering = still_lingering
+            node = group
 
-    def __call__(self, *args, **kwargs):
-        return self._context.call(self, *args, **kwargs)
+    def _retire(self, leaf):
+        if self._leaves.get(leaf.call) is not leaf:
+            # Already retired by another group it is in.
+            return
+        del self._leaves[leaf.call]
+        queue = self._pending[leaf.fcn]
+        queue.remove(leaf.sequence)
+        if len(queue) == 0:
+            self._drop_queue(leaf.fcn, queue)
 
-#
-# These are all of the builtin methods that can be mocked.
-#
-# __new__, __init__ are not listed because it is assumed that the mock
-# object already exists before the function under test is called.
-#
-# __del__ is not listed because it's hard to predict when an object
-# will be garbage collected.
-#
-# __setattr__ is not listed because it's needed for setting up the
-# mock object.
-#
-# __getattribute__ is not listed because it makes my head hurt.
-#
-# __repr__ is used when printing mock objects
-#
-# __eq__ is used when comparing mock objects used as argements to mock
-# functions.
-#
+    def _park(self, leaf):
+        parked = self._parked.get(leaf.fcn)
+        if parked is None:
+            parked = self._parked[leaf.fcn] = {}
+        parked[leaf.sequence] = leaf
 
-BUILTINS = """
-    abs add and call cmp coerce complex contains delattr delete
-    delitem delslice div divmod enter exit float floordiv ge get
-    getitem getslice gt hash hex iadd iand idiv ifloordiv
-    ilshift imod imul index int invert ior ipow isub iter itruediv
-    ixor le len long lshift lt mod mul ne neg nonzero oct or pos pow
-    radd rand rdiv rdivmod reversed rfloordiv rlshift rmod rmul
-    ror rpow rrshift rshift rsub rtruediv rxor set setitem
-    setslice str sub truediv unicode xor
-    """
+    def _unpark(self, leaf):
+        fcn = leaf.fcn
+        parked = self._parked[fcn]
+        del parked[leaf.sequence]
+        if len(parked) == 0:
+            del self._parked[fcn]
+        self._leaves[leaf.call] = leaf
+        queue = self._queue_for(fcn)
+        queue.append((leaf.sequence, leaf.call))
 
-def builtin_wrapper(method_name):
-    """
-    Makes a new function object that implements the given method by
-    delegating to a mock method defined on the object.
-    """
-    def wrapper(self, *args, **kwargs):
-        if method_name not in self.__dict__:
-            raise AttributeError(
-                "object '%s' has no mock method '%s'" %
-                (mock_object_names.get(id(self)), method_name)
-                )
-        return self.__dict__[method_name](*args, **kwargs)
-    return wrapper
-        
+    def _ordering_violation(self, fcn, args, kwargs):
+        """
+        If a call matches a parked call, returns a message saying
+        which call it has to wait for.  Otherwise returns None.
+        """
+        parked = self._parked.get(fcn)
+        if parked is None:
+            return None
+        for sequence in sorted(parked):
+            leaf = parked[sequence]
+            if leaf.call.mismatch(args, kwargs) is None:
+                return 'Ordering constraint violated: %s has to wait for %s' % (
+                    leaf.call, _first_pending(leaf.blocker())
+                    )
+        return None
 
-def add_builtin_proxies(name, bases, dict):
-    """
-    Metaclass that adds implements all builtin methods by delegating
-    to mock methods on the instance.
+    def call(self, fcn, *args, **kwargs):
+        return self.dispatch(fcn, args, kwargs)
 
-    This is necessary because for some builting methods, Python
-    doesn't look for them in the instance, only in the class.
-    """
-    for abbreviated_name in BUILTINS.split():
-        method_name = "__%s__" % abbreviated_name
-        dict[method_name] = builtin_wrapper(method_name)
-    return type(name, bases, dict)
+    def dispatch(self, fcn, args, kwargs):
+        """
+        Handles a call to a mock function, given the tuple of
+        positional arguments and dict of keyword arguments it was
+        called with.  Returns the expected return value, or raises the
+        expected exception.
+        """
+        call = self.match(fcn, args, kwargs)
+        if call.exception is not None:
+            raise call.exception
+        return_value = call.return_value
+        if type(return_value) is LazyReturn:
+            return self.compute(fcn, return_value, args, kwargs)
+        return return_value
 
-mock_object_names = {} # mapping from ID to name
+    def compute(self, fcn, lazy_return, args, kwargs):
+        """
+        Computes a lazy return value for an actual call.  If it has run
+        out of values, the call fails like one that wasn't expected.
+        """
+        try:
+            return lazy_return.compute(args, kwargs)
+        except _ValuesExhausted as e:
+            raise self.reject(fcn, args, kwargs, str(e))
 
-class MockObject(object):
+    def match(self, fcn, args, kwargs):
+        """
+        Finds the expected call that matches an actual call, marks it
+        completed, and returns it.  Raises a MockException if there
+        isn't one.
+        """
+        if self.statistics is not None:
+            return self._measured_match(fcn, args, kwargs)
+        if self._thread_safe:
+            with self._lock_for(fcn):
+                return self._match(fcn, args, kwargs)
+        else:
+            return self._match(fcn, args, kwargs)
 
-    """
-    A class that can pretend to be an arbitrary object.
+    def reject(self, fcn, args, kwargs, message):
+        """
+        Fails an actual call that was refused before it could be
+        matched, like one that the real function would not accept, or
+        that matched but couldn't get a return value.  Returns the
+        MockException to raise.
+        """
+        if self._thread_safe:
+            with self._lock_for(fcn):
+                return self._make_exception(
+                    message,
+                    ExpectedCall(fcn, args, kwargs)
+                    )
+        return self._make_exception(message, ExpectedCall(fcn, args, kwargs))
 
-    This class has no methods (other than the constructor).  It is
-    just a container for whatever attributes you assign to it.
-    """
+    def _measured_match(self, fcn, args, kwargs):
+        start = _perf_counter()
+        try:
+            if self._thread_safe:
+                with self._lock_for(fcn):
+                    call = self._match(fcn, args, kwargs)
+            else:
+                call = self._match(fcn, args, kwargs)
+        except MockException:
+            self.statistics.add(fcn, False, _perf_counter() - start)
+            raise
+        self.statistics.add(fcn, True, _perf_counter() - start)
+        return call
 
-    __metaclass__ = add_builtin_proxies
+    def _match(self, fcn, args, kwargs):
+        if self._ordering == ORDERED:
+            return self._match_ordered(fcn, args, kwargs)
+        elif self._ordering == PER_FUNCTION:
+            return self._match_indexed(fcn, args, kwargs)
+        else:
+            return self._match_unordered(fcn, args, kwargs)
 
-    def __init__(self, context, name, methods, **kwargs):
-        
+    def _complete(self, call):
         """
-        Creates a new mock object with the attributes specified by the
-        keyword arguments passed in.
+        Records one match of an expected call.  Returns True if the
+        call can't be matched again and should be removed from the
+        pending calls.
+
+        A repeated call only goes into the completed calls once, and
+        its call_count says how many times it matched.
         """
-        
-        mock_object_names[id(self)] = name
-        for method in methods:
-            fcn_name = name + '.' + method
-            self.__dict__[method] = MockFunction(context, fcn_name)
-        for (key, value) in kwargs.items():
-            self.__dict__[key] = value
+        if call is self._last_call:
+            self._last_call = None
+        if call.max_count == 1:
+            self._add_completed(call)
+            return True
+        call.call_count += 1
+        if call.call_count == 1:
+            self._add_completed(call)
+        return call.call_count == call.max_count
 
-    def __del__(self):
-        del mock_object_names[id(self)]
+    def _add_completed(self, call):
+        if self._fingerprint_history:
+            call = call.describe(fingerprint, False)
+        if self._thread_safe:
+            with self._history_lock:
+                self._completed_calls.append(call)
+                self._completed_count += 1
+        else:
+            self._completed_calls.append(call)
+            self._completed_count += 1
 
-    def __getattr__(self, name):
+    def _match_ordered(self, fcn, args, kwargs):
+        while True:
+            if len(self._calls) == 0:
+                raise self._make_exception(
+                    'Unexpected call',
+                    ExpectedCall(fcn, args, kwargs)
+                    )
+            call = self._calls[0]
+            if call.fcn != fcn:
+                mismatch = 'Wrong call'
+            else:
+                mismatch = call.mismatch(args, kwargs)
+            if mismatch is None:
+                break
+            # A repeated call that has been matched enough times steps
+            # aside for whatever comes next.
+            if not call.is_satisfied():
+                raise self._make_exception(
+                    mismatch,
+                    ExpectedCall(fcn, args, kwargs),
+                    call if call.fcn == fcn else None
+                    )
+            self._pop_ordered()
+        if self._complete(call):
+            self._pop_ordered()
+        return call
+
+    def _pop_ordered(self):
         """
-        This method is called when an attribute is requested but is
-        not present.
+        Removes the call at the front of the ordered queue.  If it
+        came from a stream, the stream is right behind it, and its next
+        call is brought out in front of it.
         """
-        raise MockException(
-            "Mock object %s has no attribute '%s'" %
-            (mock_object_names[id(self)], name)
-            )
+        calls = self._calls
+        calls.popleft()
+        if len(calls) != 0 and type(calls[0]) is _CallStream:
+            stream = calls[0]
+            call = stream.next_call()
+            if stream.is_exhausted():
+                calls.popleft()
+            calls.appendleft(call)
 
-    def __eq__(self, other):
+    def _match_indexed(self, fcn, args, kwargs):
+        queue = self._pending.get(fcn)
+        if queue is None:
+            raise self._make_exception(
+                'Unexpected call',
+                ExpectedCall(fcn, args, kwargs)
+                )
+        mismatch = queue[0][1].mismatch(args, kwargs)
+        while (mismatch is not None and len(queue) > 1 and
+               queue[0][1].is_satisfied()):
+            self._remove_indexed(fcn, queue, 0)
+            mismatch = queue[0][1].mismatch(args, kwargs)
+        if mismatch is not None:
+            raise self._make_exception(
+                mismatch,
+                ExpectedCall(fcn, args, kwargs),
+                queue[0][1]
+                )
+        call = queue[0][1]
+        if self._complete(call):
+            self._remove_indexed(fcn, queue, 0)
+        return call
+
+    def _match_unordered(self, fcn, args, kwargs):
+        # Take the first pending call that matches, and report the
+        # mismatch with the first pending call if none does.
+        queue = self._pending.get(fcn)
+        entry = None
+        if queue is not None:
+            entry = queue.find(args, kwargs)
+        if entry is None:
+            mismatch = None
+            expected_call = None
+            if self._parked:
+                mismatch = self._ordering_violation(fcn, args, kwargs)
+            if mismatch is None and queue is None:
+                mismatch = 'Unexpected call'
+            if mismatch is None:
+                expected_call = queue.first_call()
+                mismatch = expected_call.mismatch(args, kwargs)
+            raise self._make_exception(
+                mismatch,
+                ExpectedCall(fcn, args, kwargs),
+                expected_call
+                )
+        (sequence, call) = entry
+        leaf = None
+        if self._leaves:
+            leaf = self._leaves.get(call)
+            if leaf is not None:
+                self._retire_before(leaf)
+        if self._complete(call):
+            queue.remove(sequence)
+            if len(queue) == 0:
+                self._drop_queue(fcn, queue)
+            if leaf is not None:
+                del self._leaves[call]
+                if not leaf.done:
+                    self._node_done(leaf)
+        elif leaf is not None and not leaf.done and call.is_satisfied():
+            self._node_done(leaf)
+            self._linger(leaf)
+        return call
+
+    def _remove_indexed(self, fcn, queue, index):
         """
-        When mock objects are used as parameters to functions, they
-        are compared with '=='.  Object identity is what we want here.
+        Removes one entry from the queue of pending calls for a mock
+        function.  Like _pop_ordered, this brings out the next call of
+        a stream that comes right after it.
         """
-        return other is self
-
-    def __repr__(self):
-        return '<MockObject %s>' % mock_object_names[id(self)]
+        del queue[index]
+        if index < len(queue) and type(queue[index][1]) is _CallStream:
+            (sequence, stream) = queue[index]
+            call = stream.next_call()
+            if stream.is_exhausted():
+                del queue[index]
+            queue.insert(index, (sequence, call))
+        if len(queue) == 0:
+            self._drop_queue(fcn, queue)
 
-class TestCase(unittest.TestCase):
+    def _drop_queue(self, fcn, queue):
+        """
+        Removes the empty queue of pending calls for a mock function.
+        In a thread-safe context, a failure on another thread may have
+        reset the pending calls while this thread held only the
+        function's lock, and then the queue is already gone, and there
+        may even be a new one.  The dict is only read once, so that a
+        reset can't swap it in between checking it and deleting from
+        it.
+        """
+        if self._thread_safe:
+            with self._lock:
+                pending = self._pending
+                if pending.get(fcn) is queue:
+                    del pending[fcn]
+        else:
+            pending = self._pending
+            if pending.get(fcn) is queue:
+                del pending[fcn]
 
-    """
-    Subclass of unittest.TestCase that checks to make sure that all
-    expected function calls have happened.  If you use self.mock_fcn()
-    and self.mock_obj() to make your mocks, then you don't have to
-    worry about calling check_done on them.
+    def _pending_calls(self):
+        """
+        Returns an iterator over all of the calls still expected, in
+        the order they were expected.
+        """
+        if self._ordering == ORDERED:
+            return iter(self._calls)
+        queues = list(self._pending.values())
+        if self._thread_safe:
+            # Other threads may still change the queues.  list()
+            # copies one without letting them in part way through.
+            queues = [list(queue) for queue in queues]
+        if self._parked:
+            queues.append(sorted(
+                (leaf.sequence, leaf.call)
+                for parked in self._parked.values()
+                for leaf in parked.values()
+                ))
+        merged = heapq.merge(*queues, key = _entry_sequence)
+        return (call for (_, call) in merged)
 
-    You do need to make sure that if you implement setUp() and
-    tearDown() methods that you call super.
-    """
+    def _pending_count(self):
+        if self._ordering == ORDERED:
+            return len(self._calls)
+        return (
+            sum(len(queue) for queue in self._pending.values()) +
+            sum(len(parked) for parked in self._parked.values())
+            )
 
-    def setUp(self):
+    def check_done(self):
         """
-        Get ready to make mock objects.
+        Makes sure that all of the calls that were expected have
+        happened.  Raises an exception if not.
+
+        In a thread-safe context, this first raises the earliest
+        failure that happened on another thread.
         """
-        super(TestCase, self).setUp()
-        self._context = CallContext()
+        if self._thread_safe and len(self._thread_failures) != 0:
+            failure = self._thread_failures[0]
+            self._thread_failures = []
+            raise failure
+        for call in self._pending_calls():
+            if not call.is_satisfied():
+                message = "Still expecting more function calls"
+                unfinished = [
+                    stream.progress() for stream in self._pending_calls()
+                    if type(stream) is _CallStream
+                    ]
+                if len(unfinished) != 0:
+                    message += ' (%s)' % ', '.join(unfinished)
+                raise self._make_exception(message, None)
 
-    def tearDown(self):
+    def _make_exception(self, message, actual_call, expected_call = None):
         """
-        Make sure that all of the expected things happened.
+        Makes the exception for a failure, and resets the context.
+
+        The report holds on to the containers of completed and pending
+        calls, which the context replaces rather than clears, so most
+        of the message can be rendered later without copying anything
+        now.  In a thread-safe context, this holds the context's lock,
+        so that no queues of pending calls are added or dropped while
+        they are collected (see _queue_for).
         """
-        super(TestCase, self).tearDown()
-        self._context.check_done()
+        if self._thread_safe:
+            with self._lock:
+                return self._reset(message, actual_call, expected_call)
+        return self._reset(message, actual_call, expected_call)
 
-    def mock_fcn(self, name):
+    def _reset(self, message, actual_call, expected_call):
+        report = _FailureReport(
+            message,
+            self._completed_calls,
+            self._completed_count,
+            actual_call,
+            expected_call,
+            self._pending_calls(),
+            self._pending_count()
+            )
+        result = MockException(message, report)
+        if self._thread_safe and threading.current_thread() is not self._owner:
+            self._thread_failures.append(result)
+        self._calls = collections.deque()
+        self._pending = {}
+        self._group = None
+        self._parked = {}
+        self._leaves = {}
+        self._last_call = None
+        self._completed_calls = collections.deque(maxlen = self._history_size)
+        self._completed_count = 0
+        return result
+
+    def _check_last_call(self, fcn, reason):
+        if self._last_call is None:
+            raise Exception("no call for which to set " + reason)
+        if fcn != self._last_call.fcn:
+            raise Exception(reason + " must be set immediately after expect")
+
+# The real clock for call statistics, which a VirtualClock doesn't
+# replace.
+_perf_counter = time.perf_counter
+
+class FunctionStatistics(object):
+
+    """
+    The numbers collected for one mock function name: how many times it
+    was called, how many of those calls matched an expected call and
+    how many didn't, and the total seconds spent matching them.
+    """
+
+    __slots__ = ('name', 'calls', 'matches', 'mismatches', 'dispatch_time')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.matches = 0
+        self.mismatches = 0
+        self.dispatch_time = 0.0
+
+    def __repr__(self):
+        return '<FunctionStatistics {}: {:,} calls, {:,} matches, {:,} mismatches, {:.3f} ms>'.format(
+            self.name, self.calls, self.matches, self.mismatches,
+            self.dispatch_time * 1000
+            )
+
+class CallStatistics(object):
+
+    """
+    Counts and timings of the calls to mock functions in a CallContext,
+    by function name.
+    """
+
+    def __init__(self, thread_safe = False):
+        # Numbers are kept per MockFunction object, and added up by
+        # name when asked for.
+        self._by_function = {}
+        self._lock = threading.Lock() if thread_safe else None
+
+    def add(self, fcn, matched, seconds):
+        if self._lock is not None:
+            with self._lock:
+                self._add(fcn, matched, seconds)
+        else:
+            self._add(fcn, matched, seconds)
+
+    def _add(self, fcn, matched, seconds):
+        stats = self._by_function.get(fcn)
+        if stats is None:
+            stats = self._by_function[fcn] = FunctionStatistics(fcn.name)
+        stats.calls += 1
+        if matched:
+            stats.matches += 1
+        else:
+            stats.mismatches += 1
+        stats.dispatch_time += seconds
+
+    def by_name(self):
         """
-        Make a new MockFunction.  It's check_done method will be
-        called at the end of the test.
+        Returns a dict from mock function name to FunctionStatistics.
         """
-        return MockFunction(self._context, name)
+        result = {}
+        for stats in list(self._by_function.values()):
+            total = result.get(stats.name)
+            if total is None:
+                total = result[stats.name] = FunctionStatistics(stats.name)
+            total.calls += stats.calls
+            total.matches += stats.matches
+            total.mismatches += stats.mismatches
+            total.dispatch_time += stats.dispatch_time
+        return result
 
-    def mock_obj(self, name, methods = [], **kwargs):
+    def get(self, name):
         """
-        Make a new MockObject.
+        Returns the FunctionStatistics for a mock function name.
         """
-        return MockObject(self._context, name, methods, **kwargs)
+        return self.by_name().get(name) or FunctionStatistics(name)
 
-    def patch(self, obj, field, value):
+    def most_called(self, count = None):
         """
-        Convenience method to make Patch objects.
+        Returns FunctionStatistics for the most called functions, most
+        called first.
         """
-        return Patch(obj, field, value)
+        result = sorted(
+            self.by_name().values(),
+            key = lambda stats: (-stats.calls, stats.name)
+            )
+        return result[:count]
 
-    def patch_set(self, *patch_tuples):
+    def total_time(self):
         """
-        Convenience method to make PatchSet objects.
+        Returns the total seconds spent matching mock function calls.
         """
-        return PatchSet(*patch_tuples)
+        return sum(s.dispatch_time for s in list(self._by_function.values()))
 
-class Patch(object):
+    def __str__(self):
+        text = ['%-30s %10s %10s %10s %12s' % (
+            'function', 'calls', 'matches', 'mismatches', 'time (ms)'
+            )]
+        for stats in self.most_called():
+            text.append('%-30s %10d %10d %10d %12.3f' % (
+                stats.name, stats.calls, stats.matches, stats.mismatches,
+                stats.dispatch_time * 1000
+                ))
+        return '\n'.join(text)
+
+def _entry_sequence(entry):
+    return entry[0]
+
+class _CallStream(object):
 
     """
-    A context for use in a with statement to temporarily replace a
-    member of a module or object with a new value.
+    Expected calls that are read from an iterator only as they are
+    needed, so that they don't all have to be in memory at once.
+
+    In a queue of pending calls, a stream sits right after the last
+    call it produced.  It reads one call ahead so that it knows when
+    it is exhausted, and is taken out of the queue then.
+
+    For failure messages, it remembers the last few calls it produced.
+    Showing a failure doesn't read any further ahead, because that
+    would change what the iterator produces.
     """
 
-    def __init__(self, obj, field, value):
+    __slots__ = ('_calls', '_next', '_recent', '_description', '_produced')
+
+    def __init__(self, calls, description):
+        self._calls = iter(calls)
+        self._next = next(self._calls, None)
+        # The current call, and the ones before it.
+        self._recent = collections.deque(maxlen = STREAM_WINDOW + 1)
+        self._description = description
+        self._produced = 0
+
+    def is_exhausted(self):
+        return self._next is None
+
+    def is_satisfied(self):
+        return self._next is None
+
+    def next_call(self):
+        call = self._next
+        self._next = next(self._calls, None)
+        self._produced += 1
+        self._recent.append(call)
+        return call
+
+    def progress(self):
         """
-        Creates a new context.  The named field of the module or
-        object will be replaced with the given value just for the
-        duration of the context.
+        Says how far the stream got, for when it wasn't finished.  The
+        last call produced is still waiting in the queue, so it doesn't
+        count.
         """
-        self._object = obj
-        self._field = field
-        self._value = value
+        return '{} not finished after {:,} calls'.format(
+            self._description, max(self._produced - 1, 0)
+            )
 
-    def __enter__(self):
-        # We get the previous value through the __dict__ rather than using
-        # getattr, since getattr transforms static and class methods into
-        # functions and bound methods, respectively.  We just want the raw
-        # value so that we can restore it easily on context exit.
-        self._prev_value = self._object.__dict__.get(self._field)
-        setattr(self._object, self._field, self._value)
+    def __str__(self):
+        lines = ['... more calls from {}, at call {:,}:'.format(
+            self._description, self._produced
+            )]
+        position = self._produced - len(self._recent) + 1
+        for call in self._recent:
+            marker = '->' if position == self._produced else ''
+            lines.append('{:>3} {:,}: {}'.format(marker, position, call))
+            position += 1
+        if self._next is not None:
+            lines.append('    {:,}: {}'.format(position, self._next))
+        return '\n'.join(lines)
 
-    def __exit__(self, *args):
-        if self._prev_value is None:
-            delattr(self._object, self._field)
-        else:
-            setattr(self._object, self._field, self._prev_value)
+class _Group(object):
 
-class PatchSet(object):
+    """
+    A node in the graph of ordering constraints, holding calls and
+    other groups, which are done either in order or in any order.
+
+    An active group is one that can start.  An in-order group keeps
+    the index of the first of its children that isn't done, which is
+    the only active one; an any-order group counts how many of its
+    children aren't done, and they are all active.  A group is done
+    when all of its children are, and no more can be added to it.
 
+    An in-order group also keeps the calls in it that are done but can
+    still be matched, like one expected with at_least, as (branch,
+    leaf) pairs.  They stop being expected once a call in a later
+    branch of the group happens.
     """
-    A context for use in a with statement to apply multiple Patches (see above)
-    at once.  Each patch is specified as a 3-tuple corresponding to the
-    arguments of Patch.
+
+    __slots__ = (
+        'ordered', 'children', 'parent', 'branch', 'position', 'remaining',
+        'open', 'active', 'done', 'lingering'
+        )
+
+    def __init__(self, ordered):
+        self.ordered = ordered
+        self.children = []
+        self.parent = None
+        self.branch = None
+        self.position = 0
+        self.remaining = 0
+        self.open = True
+        self.active = False
+        self.done = False
+        self.lingering = []
+
+    def is_complete(self):
+        if self.open:
+            return False
+        if self.ordered:
+            return self.position == len(self.children)
+        return self.remaining == 0
+
+class _Leaf(object):
+
+    """
+    A node in the graph of ordering constraints for one expected
+    call.  It is done once the call has been matched enough times.
     """
 
-    def __init__(self, *patch_tuples):
-        """
-        Creates a new context.  Each patch_tuple should be a 3-tuple
-        corresponding to the arguments of Patch.  For example:
+    __slots__ = (
+        'fcn', 'call', 'sequence', 'parent', 'branch', 'active', 'done'
+        )
 
-            with PatchSet(
-                    (time, 'sleep', sleep),
-                    (time, 'clock', clock)
-                    ):
-                run_with_patched_time()
+    def __init__(self, fcn, call, sequence):
+        self.fcn = fcn
+        self.call = call
+        self.sequence = sequence
+        self.parent = None
+        self.branch = None
+        self.active = False
+        self.done = False
 
-        is largely equivalent to:
-        
-            with Patch(time, 'sleep', sleep):
-                with Patch(time, 'clock', clock):
-                    run_with_patched_time()
+    def blocker(self):
         """
-        self._patches = [
-                Patch(patch_tuple[0], patch_tuple[1], patch_tuple[2])
-                for patch_tuple in patch_tuples
-                ]
+        Returns the outermost node that has to be done before this
+        one can be active.
+        """
+        result = None
+        node = self
+        while node.parent is not None:
+            group = node.parent
+            if group.ordered and group.position < node.branch:
+                result = group.children[group.position]
+            node = group
+        return result
+
+def _first_pending(node):
+    """
+    Describes the first call in a node that hasn't been done yet.
+    """
+    while type(node) is _Group:
+        if node.ordered:
+            if len(node.children) <= node.position:
+                return 'the calls before it'
+            node = node.children[node.position]
+        else:
+            pending = [child for child in node.children if not child.done]
+            if len(pending) == 0:
+                return 'the calls before it'
+            node = pending[0]
+    if node is None:
+        return 'the calls before it'
+    return str(node.call)
+
+class _GroupBuilder(object):
+
+    """
+    The context manager returned by CallContext.in_order and
+    CallContext.any_order.
+    """
+
+    def __init__(self, context, ordered):
+        self._context = context
+        self._ordered = ordered
+        self._group = None
 
     def __enter__(self):
-        for patch in self._patches:
-            patch.__enter__()
+        self._group = _Group(self._ordered)
+        self._context._open_group(self._group)
+        return self
 
     def __exit__(self, *args):
-        for patch in self._patches:
-            patch.__exit__(*args)
-        
-class TestMock(TestCase):
+        self._context._close_group(self._group)
 
-    def test_function_return_value(self):
-        f = self.mock_fcn('f').expect().returns(2)
-        self.assertEquals(2, f())
+# Marks the keys made by _call_key for calls with keyword arguments,
+# so that they can't be confused with the key of some other call.
+_KWARGS_KEY = object()
 
-    def test_function_raises(self):
-        f = self.mock_fcn('f').expect(2).raises(OSError('kaboom'))
-        def should_raise():
-            f(2)
-        self.assertRaises(OSError, should_raise)
+# Argument types that are hashed without running any user code.
+_PLAIN_TYPES = frozenset([int, float, str, bytes, bool, type(None)])
 
-    def test_function_arg_mismatch(self):
-        f = self.mock_fcn('f').expect(1)
-        def should_raise():
-            f(2)
+# Hashable types equal to values of unhashable ones.
+_HASHABLE_EQUIVALENTS = {bytearray: bytes, set: frozenset}
+
+def _check_hashable(values):
+    """
+    Raises TypeError if hashing the values would call a mock object's
+    __hash__, which could be a mocked method.
+    """
+    for value in values:
+        if type(value) in _PLAIN_TYPES:
+            continue
+        if isinstance(value, MockObject):
+            raise TypeError('mock objects are not hashed')
+        if type(value) is tuple:
+            _check_hashable(value)
+
+def _call_key(args, kwargs):
+    """
+    Returns a hashable key for the arguments of a call.  Two calls
+    have equal keys when their arguments are equal.  Raises TypeError
+    if some of the arguments aren't hashable, or are mock objects.
+    """
+    _check_hashable(args)
+    if len(kwargs) == 0:
+        hash(args)
+        return args
+    _check_hashable(kwargs.values())
+    return (_KWARGS_KEY, args, frozenset(kwargs.items()))
+
+def _equivalent_key(args, kwargs):
+    """
+    Returns the key of the hashable arguments that are equal to the
+    arguments of a call that can't be hashed, or None if there are
+    none.  Only bytearray and set arguments have hashable equivalents.
+    """
+    def equivalent(value):
+        convert = _HASHABLE_EQUIVALENTS.get(type(value))
+        if convert is None:
+            return value
+        return convert(value)
+    try:
+        return _call_key(
+            tuple(equivalent(value) for value in args),
+            dict((name, equivalent(value)) for (name, value) in kwargs.items())
+            )
+    except TypeError:
+        return None
+
+class _UnorderedCalls(object):
+
+    """
+    The pending calls to one mock function in an UNORDERED context.
+
+    Matching takes the earliest expected call that matches, like
+    checking them one at a time would, but without looking at all of
+    them.  Calls whose arguments are plain, hashable values are kept
+    in a dict by their arguments, so they can be found in one step.
+    Calls with matchers, or with arguments that can't be hashed (or
+    are mock objects, whose __hash__ may be mocked), go in a list in
+    the order they were expected, which is checked up to the first
+    match.  Only the matchers of calls expected before the one that
+    matches see the arguments, just as before.
+
+    An actual call whose arguments can't be hashed is only checked
+    against the list, and against the calls in the dict whose
+    arguments are equal to it, like bytes to a bytearray.  Hashable
+    values aren't equal to unhashable ones otherwise.
+
+    Like a queue of pending calls for PER_FUNCTION, the entries are
+    (sequence_number, call) pairs, and a stream sits right after the
+    call it produced, with the same sequence number.
+    """
+
+    __slots__ = ('_calls', '_by_key', '_fallback', '_streams')
+
+    def __init__(self):
+        # Sequence number -> (call, key), where key is None for the
+        # calls in the fallback list.
+        self._calls = {}
+        # Key -> sorted list of (sequence_number, call).
+        self._by_key = {}
+        # Sorted list of (sequence_number, call).
+        self._fallback = []
+        # Sequence number of the call a stream produced -> stream.
+        self._streams = {}
+
+    def __len__(self):
+        return len(self._calls) + len(self._streams)
+
+    def __iter__(self):
+        """
+        Iterates over all of the entries, in the order they were
+        expected.
+        """
+        # Copies, in case another thread changes them while this runs.
+        calls = dict(self._calls)
+        streams = dict(self._streams)
+        for sequence in sorted(set(calls).union(streams)):
+            if sequence in calls:
+                yield (sequence, calls[sequence][0])
+            if sequence in streams:
+                yield (sequence, streams[sequence])
+
+    def append(self, entry):
+        (sequence, call) = entry
+        if type(call) is _CallStream:
+            self._streams[sequence] = call
+            return
+        key = None
+        if not call.has_matchers():
+            try:
+                key = _call_key(call.args, call.kwargs)
+            except TypeError:
+                pass
+        self._calls[sequence] = (call, key)
+        if key is None:
+            bisect.insort(self._fallback, entry)
+        else:
+            bucket = self._by_key.get(key)
+            if bucket is None:
+                self._by_key[key] = [entry]
+            else:
+                bisect.insort(bucket, entry)
+
+    def find(self, args, kwargs):
+        """
+        Returns the (sequence_number, call) entry for the earliest
+        pending call that matches, or None.
+        """
+        try:
+            key = _call_key(args, kwargs)
+        except TypeError:
+            key = _equivalent_key(args, kwargs)
+        bucket = None
+        if key is not None:
+            bucket = self._by_key.get(key)
+        if bucket is None:
+            return self._scan(self._fallback, args, kwargs)
+        first = bucket[0]
+        if len(self._fallback) != 0 and self._fallback[0][0] < first[0]:
+            earlier = itertools.takewhile(
+                lambda entry: entry[0] < first[0],
+                self._fallback
+                )
+            entry = self._scan(earlier, args, kwargs)
+            if entry is not None:
+                return entry
+        return first
+
+    def _scan(self, entries, args, kwargs):
+        for entry in entries:
+            if entry[1].mismatch(args, kwargs) is None:
+                return entry
+        return None
+
+    def first_call(self):
+        return self._calls[min(self._calls)][0]
+
+    def remove(self, sequence):
+        """
+        Removes the call with the given sequence number.  If a stream
+        produced it, the stream's next call takes its place.
+        """
+        (call, key) = self._calls.pop(sequence)
+        if key is None:
+            entries = self._fallback
+        else:
+            entries = self._by_key[key]
+        index = bisect.bisect_left(entries, (sequence,))
+        del entries[index]
+        if key is not None and len(entries) == 0:
+            del self._by_key[key]
+        stream = self._streams.get(sequence)
+        if stream is not None:
+            call = stream.next_call()
+            if stream.is_exhausted():
+                del self._streams[sequence]
+            self.append((sequence, call))
+
+class _FailureReport(object):
+
+    """
+    Everything needed to write the message for a failure in a
+    CallContext.  Long lists of calls are cut down to
+    MAX_REPORTED_CALLS lines each.
+
+    The actual call and its differences from the expected call are
+    written out right away, because the caller may change its
+    arguments after the failure.  They are short, since arguments are
+    shown with short_repr.
+    """
+
+    def __init__(self, message, completed_calls, completed_count,
+                 actual_call, expected_call, pending_calls, pending_count):
+        self._message = message
+        self._completed_calls = completed_calls
+        self._completed_count = completed_count
+        self._actual_call = None
+        if actual_call is not None:
+            self._actual_call = str(actual_call)
+        self._differences = []
+        if expected_call is not None:
+            self._differences = expected_call.describe_mismatch(
+                actual_call.args,
+                actual_call.kwargs
+                )
+        self._pending_calls = pending_calls
+        self._pending_count = pending_count
+
+    def render(self):
+        text = [self._message]
+        text.append('')
+        text.append('Completed calls:')
+        shown = min(len(self._completed_calls), MAX_REPORTED_CALLS)
+        not_shown = self._completed_count - shown
+        if not_shown != 0:
+            text.append('({:,} earlier calls not shown)'.format(not_shown))
+        skip = len(self._completed_calls) - shown
+        for call in itertools.islice(self._completed_calls, skip, None):
+            text.append(str(call))
+        text.append('')
+        if self._actual_call is not None:
+            text.append('Actual call:')
+            text.append(self._actual_call)
+            text.append('')
+        if len(self._differences) != 0:
+            text.append('Differences:')
+            text.extend(self._differences)
+            text.append('')
+        text.append('Expected calls:')
+        for call in itertools.islice(self._pending_calls, MAX_REPORTED_CALLS):
+            text.append(str(call))
+        not_shown = self._pending_count - MAX_REPORTED_CALLS
+        if 0 < not_shown:
+            text.append('... {:,} more expected calls'.format(not_shown))
+        return '\n'.join(text)
+
+
+class _ValuesExhausted(Exception):
+
+    """
+    Raised by a LazyReturn when the iterator it pulls values from
+    runs out.  The context turns it into a MockException.
+    """
+
+class LazyReturn(object):
+
+    """
+    A return value that isn't known until the call happens.  It is
+    computed from the arguments of the actual call by a function.
+
+    Lazy return values that are pulled from an iterator are stateful:
+    each one can only be used once.  They have a lock, so that calls
+    on different threads don't advance the iterator at the same time.
+    """
+
+    __slots__ = ('_fcn', '_description', 'stateful', '_lock')
+
+    def __init__(self, fcn, description = None, stateful = False):
+        self._fcn = fcn
+        if description is None:
+            description = 'computed by %s' % getattr(
+                fcn, '__name__', repr(fcn)
+                )
+        self._description = description
+        self.stateful = stateful
+        self._lock = threading.Lock() if stateful else None
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        Makes a LazyReturn that returns the next value from an
+        iterable.
+        """
+        iterator = iter(values)
+        description = 'values from %s' % getattr(
+            values, '__name__', type(values).__name__
+            )
+        def next_value(*args, **kwargs):
+            try:
+                return next(iterator)
+            except StopIteration:
+                raise _ValuesExhausted('Ran out of %s' % description)
+        return cls(next_value, description, True)
+
+    def compute(self, args, kwargs):
+        """
+        Returns the value for a call with the given arguments.  Raises
+        _ValuesExhausted if there are no more values.
+        """
+        if self._lock is None:
+            return self._fcn(*args, **kwargs)
+        with self._lock:
+            return self._fcn(*args, **kwargs)
+
+    def __repr__(self):
+        return '<%s>' % self._description
+
+class MockFunction(object):
+
+    """
+    An object that mimics a function, checking the values passed in as
+    arguments, and returning a value or raising an exception.
+    """
+
+    __slots__ = ('_context', 'name')
+
+    def __init__(self, context, name):
+        """
+        Creates a new MockFunction with the given name.
+        """
+        self._context = context
+        self.name = name
+
+    def expect(self, *args, **kwargs):
+        """
+        Adds another expected call to this function, expecting the
+        arguments and keyword argumentsgiven.
+
+        Returns this MockFunction so that a return value can be added
+        on.
+        """
+        self._context.expect(self, *args, **kwargs)
+        return self
+
+    def returns(self, return_value):
+        """
+        Specifies the value to be returned.  Returns this MockFunction
+        object so that another call can be chained on.
+        """
+        self._context.set_last_return(self, return_value)
+        return self
+
+    def returns_from(self, values):
+        """
+        Specifies that the current call returns the next value from an
+        iterable each time it is matched.  Use it with times or
+        at_least, so that values like result pages are made only when
+        they are needed, and can be freed once they have been used.
+
+        Returns this MockFunction so another call can be chained on.
+        """
+        self._context.set_last_return(self, LazyReturn.from_values(values))
+        return self
+
+    def returns_computed(self, fcn):
+        """
+        Specifies that the current call returns the result of calling
+        fcn with the arguments of the actual call.
+
+        Returns this MockFunction so another call can be chained on.
+        """
+        self._context.set_last_return(self, LazyReturn(fcn))
+        return self
+
+    def raises(self, exception):
+        """
+        Specifies an exception to be raised in response to the current
+        call.
+
+        Returns this MockFunction so another call can be chained on.
+        """
+        self._context.set_last_exception(self, exception)
+        return self
+
+    def times(self, count):
+        """
+        Specifies that the current call is expected exactly count
+        times in a row.  Returns this MockFunction so another call can
+        be chained on.
+        """
+        if count < 1:
+            raise ValueError("count must be at least 1")
+        self._context.set_last_count(self, count, count)
+        return self
+
+    def at_least(self, count):
+        """
+        Specifies that the current call is expected count or more
+        times in a row.  Returns this MockFunction so another call can
+        be chained on.
+        """
+        self._context.set_last_count(self, count, None)
+        return self
+
+    def any_number(self):
+        """
+        Specifies that the current call may happen any number of
+        times in a row, including none.  Returns this MockFunction so
+        another call can be chained on.
+        """
+        self._context.set_last_count(self, 0, None)
+        return self
+
+    def expect_cassette(self, path):
+        """
+        Expects the calls recorded in a cassette file by a Recorder,
+        in the order they were recorded, returning or raising what the
+        real function did.  The file is read as the calls are made, so
+        a large cassette doesn't have to fit in memory.  The calls
+        have to happen in order even in an UNORDERED context.
+
+        Returns this MockFunction so another call can be chained on.
+        """
+        self._context.expect_stream(
+            self,
+            _cassette_calls(self, path),
+            'cassette %r' % path
+            )
+        return self
+
+    def expect_stream(self, calls, description = None):
+        """
+        Expects the calls described by an iterable of Call objects, in
+        order.  The iterable is only read as the calls are made, so a
+        generator can script any number of calls in constant memory.
+        The description is used in failure messages, and defaults to
+        the name of the generator.  The calls have to happen in order
+        even in an UNORDERED context.
+
+        Returns this MockFunction so another call can be chained on.
+        """
+        if description is None:
+            description = 'stream %s' % getattr(
+                calls, '__name__', type(calls).__name__
+                )
+        self._context.expect_stream(
+            self,
+            _stream_calls(self, calls),
+            description
+            )
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self._context.dispatch(self, args, kwargs)
+
+class Call(object):
+
+    """
+    Describes one expected call, for MockFunction.expect_stream.  The
+    constructor takes the expected arguments, and the return value,
+    exception, and delay can be chained on, as with a MockFunction:
+
+        def pages():
+            for i in itertools.count():
+                yield Call(page = i).returns(['item'])
+    """
+
+    __slots__ = ('args', 'kwargs', 'return_value', 'exception', 'delay')
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.return_value = None
+        self.exception = None
+        self.delay = 0
+
+    def returns(self, return_value):
+        self.return_value = return_value
+        return self
+
+    def raises(self, exception):
+        self.exception = exception
+        return self
+
+    def delays(self, seconds):
+        self.delay = seconds
+        return self
+
+def _stream_calls(fcn, calls):
+    """
+    Generates the expected calls described by Call objects.
+    """
+    for item in calls:
+        if not isinstance(item, Call):
+            raise TypeError(
+                'streams of expected calls hold Call objects, not %r' %
+                (item,)
+                )
+        call = ExpectedCall(
+            fcn,
+            _wrap_arrays(item.args),
+            _wrap_arrays(item.kwargs)
+            )
+        call.return_value = item.return_value
+        call.exception = item.exception
+        call.delay = item.delay
+        yield call
+
+class AsyncMockFunction(MockFunction):
+
+    """
+    A mock of an "async def" function.  Calling it checks the call
+    against the expected calls right away, like any other mock
+    function, and returns a coroutine.  Awaiting the coroutine waits
+    for the expected delay on the event loop's clock, and then returns
+    the expected value or raises the expected exception.
+    """
+
+    __slots__ = ()
+
+    def delays(self, seconds):
+        """
+        Specifies how long awaiting the current call takes.  Returns
+        this AsyncMockFunction so another call can be chained on.
+        """
+        self._context.set_last_delay(self, seconds)
+        return self
+
+    def __call__(self, *args, **kwargs):
+        call = self._context.match(self, args, kwargs)
+        return_value = call.return_value
+        if type(return_value) is LazyReturn and call.exception is None:
+            return_value = self._context.compute(
+                self, return_value, args, kwargs
+                )
+        return _resolve(call, return_value)
+
+async def _resolve(call, return_value):
+    if call.delay != 0:
+        await asyncio.sleep(call.delay)
+    if call.exception is not None:
+        raise call.exception
+    return return_value
+
+class _VirtualTimeSelector(object):
+
+    """
+    Wraps a real selector for a VirtualTimeEventLoop.  When the loop
+    would wait for its next timer, this moves the clock forward to
+    the timer instead of waiting.
+    """
+
+    def __init__(self, clock, selector):
+        self._clock = clock
+        self._selector = selector
+
+    def select(self, timeout = None):
+        events = self._selector.select(0)
+        if len(events) != 0 or timeout == 0:
+            return events
+        if timeout is None:
+            # Nothing is scheduled, so the loop is waiting for real
+            # I/O or another thread.
+            return self._selector.select(None)
+        self._clock.advance(timeout)
+        return events
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+
+    """
+    An event loop that runs on a VirtualClock.  Whenever there is
+    nothing to do but wait for a timer, the clock jumps ahead to it,
+    so asyncio.sleep() and timeouts take no real time.
+    """
+
+    def __init__(self, clock = None):
+        if clock is None:
+            clock = VirtualClock()
+        self.clock = clock
+        super(VirtualTimeEventLoop, self).__init__(
+            _VirtualTimeSelector(clock, selectors.DefaultSelector())
+            )
+
+    def time(self):
+        return self.clock.monotonic()
+
+#
+# These are all of the builtin methods that can be mocked.
+#
+# __new__, __init__ are not listed because it is assumed that the mock
+# object already exists before the function under test is called.
+#
+# __del__ is not listed because it's hard to predict when an object
+# will be garbage collected.
+#
+# __setattr__ is not listed because it's needed for setting up the
+# mock object.
+#
+# __getattribute__ is not listed because it makes my head hurt.
+#
+# __repr__ is used when printing mock objects
+#
+# __eq__ is used when comparing mock objects used as argements to mock
+# functions.
+#
+
+BUILTINS = """
+    abs add aenter aexit aiter and anext await bool bytes call ceil
+    cmp coerce complex contains delattr delete delitem delslice div
+    divmod enter exit float floor floordiv format fspath ge get
+    getitem getslice gt hash hex iadd iand idiv ifloordiv ilshift
+    imatmul imod imul index int invert ior ipow isub iter itruediv
+    ixor le len length_hint long lshift lt matmul missing mod mul ne
+    neg nonzero oct or pos pow radd rand rdiv rdivmod reversed
+    rfloordiv rlshift rmatmul rmod rmul ror round rpow rrshift rshift
+    rsub rtruediv rxor set setitem setslice str sub truediv trunc
+    unicode xor
+    """
+
+BUILTIN_METHODS = frozenset("__%s__" % name for name in BUILTINS.split())
+
+def builtin_wrapper(method_name):
+    """
+    Makes a new function object that implements the given method by
+    delegating to a mock method defined on the object.
+    """
+    def wrapper(self, *args, **kwargs):
+        try:
+            method = self.__dict__[method_name]
+        except KeyError:
+            raise AttributeError(
+                "object '%s' has no mock method '%s'" %
+                (self._mock_name, method_name)
+                )
+        return method(*args, **kwargs)
+    wrapper.__name__ = method_name
+    return wrapper
+
+# Subclasses of MockObject that implement a given set of builtin
+# methods, keyed by the frozenset of method names.
+_specialized_classes = {}
+
+def specialized_class(method_names):
+    """
+    Returns the subclass of MockObject that implements the given
+    builtin methods by delegating to mock methods on the instance.
+    Classes are made the first time they are needed, and reused after
+    that.
+
+    This is necessary because for builtin methods, Python doesn't look
+    for them in the instance, only in the class.  Only the methods
+    actually being mocked are defined, so that protocol checks like
+    hasattr(obj, '__len__') get the right answer for other objects.
+    """
+    cls = _specialized_classes.get(method_names)
+    if cls is None:
+        members = dict(
+            (name, builtin_wrapper(name)) for name in method_names
+            )
+        members['__slots__'] = ()
+        members['_mocked_builtins'] = method_names
+        cls = type('MockObject', (MockObject,), members)
+        cls = _specialized_classes.setdefault(method_names, cls)
+    return cls
+
+class MockObject(object):
+
+    """
+    A class that can pretend to be an arbitrary object.
+
+    This class has no methods (other than the constructor).  It is
+    just a container for whatever attributes you assign to it.
+
+    The name of the object is kept in a slot, rather than in the
+    __dict__, so that it can't collide with the attributes being
+    mocked.
+
+    Objects that mock builtin methods, like __add__ or __len__, are
+    instances of a subclass that defines just those methods (see
+    specialized_class).
+
+    Mock objects can be weakly referenced, like most real objects.
+    """
+
+    __slots__ = ('_mock_name', '__dict__', '__weakref__')
+
+    # The builtin methods this class delegates to the instance.
+    _mocked_builtins = frozenset()
+
+    def __new__(cls, context, name, methods, **kwargs):
+        if cls is MockObject and not (
+                BUILTIN_METHODS.isdisjoint(methods) and
+                BUILTIN_METHODS.isdisjoint(kwargs)
+                ):
+            mocked = BUILTIN_METHODS.intersection(methods)
+            mocked = mocked.union(BUILTIN_METHODS.intersection(kwargs))
+            cls = specialized_class(mocked)
+        return object.__new__(cls)
+
+    def __init__(self, context, name, methods, **kwargs):
+        
+        """
+        Creates a new mock object with the attributes specified by the
+        keyword arguments passed in.
+        """
+        
+        object.__setattr__(self, '_mock_name', name)
+        for method in methods:
+            fcn_name = name + '.' + method
+            self.__dict__[method] = MockFunction(context, fcn_name)
+        for (key, value) in kwargs.items():
+            self.__dict__[key] = value
+
+    def __setattr__(self, name, value):
+        """
+        Sets an attribute.  If it is a builtin method that the class
+        doesn't delegate yet, the object switches to a class that does.
+        """
+        object.__setattr__(self, name, value)
+        if name in BUILTIN_METHODS and name not in self._mocked_builtins:
+            self.__class__ = specialized_class(
+                self._mocked_builtins.union([name])
+                )
+
+    def __getattr__(self, name):
+        """
+        This method is called when an attribute is requested but is
+        not present.
+
+        Missing builtin methods raise AttributeError, so that checks
+        for protocols, like hasattr(obj, '__iter__'), work as usual.
+        """
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError(
+                "Mock object %s has no attribute '%s'" %
+                (self._mock_name, name)
+                )
+        raise MockException(
+            "Mock object %s has no attribute '%s'" %
+            (self._mock_name, name)
+            )
+
+    def __eq__(self, other):
+        """
+        When mock objects are used as parameters to functions, they
+        are compared with '=='.  Object identity is what we want here.
+        """
+        return other is self
+
+    # Defining __eq__ would otherwise make mock objects unhashable.
+    # Hashing by identity goes with comparing by identity.
+    __hash__ = object.__hash__
+
+    def __repr__(self):
+        return '<MockObject %s>' % self._mock_name
+
+class SpecMockFunction(MockFunction):
+
+    """
+    A mock function that stands in for a real one, and checks the
+    expected and actual calls against the signature of the real one.
+    An expected call that doesn't fit raises TypeError right away.  An
+    actual call that doesn't fit fails like any other unexpected call,
+    raising a MockException rather than the TypeError the real
+    function would, so that code under test that handles TypeError
+    doesn't hide it.  Like any other failure, it resets the context,
+    so if the code under test catches the MockException too, the test
+    won't know about it.
+    """
+
+    __slots__ = ('_checker',)
+
+    def __init__(self, context, name, checker):
+        """
+        Creates a new SpecMockFunction, checking calls with the given
+        SignatureChecker.
+        """
+        super(SpecMockFunction, self).__init__(context, name)
+        self._checker = checker
+
+    @property
+    def signature(self):
+        return self._checker.signature
+
+    def expect(self, *args, **kwargs):
+        error = self._checker.error(args, kwargs)
+        if error is not None:
+            raise TypeError(
+                "expected call doesn't fit %s%s: %s" %
+                (self.name, self.signature, error)
+                )
+        return super(SpecMockFunction, self).expect(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        error = self._checker.error(args, kwargs)
+        if error is not None:
+            raise self._context.reject(
+                self, args, kwargs,
+                'Signature mismatch for %s%s: %s' %
+                (self.name, self.signature, error)
+                )
+        return super(SpecMockFunction, self).__call__(*args, **kwargs)
+
+class SignatureChecker(object):
+
+    """
+    Checks whether arguments could be passed to a function with a
+    given inspect.Signature.
+
+    Whether they can depends only on how many positional arguments
+    there are and which keywords are used, so the combinations that
+    worked are remembered, and Signature.bind, which is slow, is only
+    used the first time each one is seen.
+    """
+
+    __slots__ = ('signature', '_good_shapes')
+
+    def __init__(self, signature):
+        self.signature = signature
+        self._good_shapes = set()
+
+    def error(self, args, kwargs):
+        """
+        Returns None if the arguments fit the signature, or else the
+        TypeError that calling the function would raise.
+        """
+        if len(kwargs) == 0:
+            shape = len(args)
+        else:
+            shape = (len(args), tuple(kwargs))
+        if shape in self._good_shapes:
+            return None
+        try:
+            self.signature.bind(*args, **kwargs)
+        except TypeError as e:
+            return e
+        self._good_shapes.add(shape)
+        return None
+
+class AsyncSpecMockFunction(SpecMockFunction, AsyncMockFunction):
+
+    """
+    A SpecMockFunction for an "async def" function.
+    """
+
+    __slots__ = ()
+
+# What spec_members has found out about each class or module, so
+# inspect only has to look at it once.  The keys are weak so that
+# classes made on the fly can still be freed.
+_spec_cache = weakref.WeakKeyDictionary()
+
+def spec_members(spec):
+    """
+    Returns a tuple describing the methods of a class, or the
+    functions of a module, as (name, mock_class, checker) triples.
+    The checker is a SignatureChecker, or None when inspect can't find
+    the signature, and the mock_class is the kind of mock function to
+    make for it.
+
+    For a class, the signatures leave out self, because the mocks
+    stand in for bound methods.  The public members are included,
+    along with the builtin methods, like __len__, that the class
+    defines rather than inheriting from object.
+
+    The result is computed once for each spec, and then cached.
+    """
+    members = _spec_cache.get(spec)
+    if members is None:
+        members = _spec_cache.setdefault(spec, _inspect_spec(spec))
+    return members
+
+def _inspect_spec(spec):
+    is_class = inspect.isclass(spec)
+    if not (is_class or inspect.ismodule(spec)):
+        raise TypeError('spec must be a class or a module: %r' % (spec,))
+    members = []
+    for name in dir(spec):
+        if name.startswith('_'):
+            if not is_class or name not in BUILTIN_METHODS:
+                continue
+            if getattr(spec, name) is getattr(object, name, None):
+                continue
+        try:
+            static = inspect.getattr_static(spec, name)
+            value = getattr(spec, name)
+        except AttributeError:
+            continue
+        if not callable(value):
+            # Plain attributes and properties are left for the test
+            # to set.
+            continue
+        is_async = inspect.iscoroutinefunction(value)
+        try:
+            signature = inspect.signature(value)
+        except (TypeError, ValueError):
+            signature = None
+        if signature is not None and is_class and _takes_self(static, value):
+            parameters = list(signature.parameters.values())[1:]
+            signature = signature.replace(parameters = parameters)
+        if signature is None:
+            mock_class = AsyncMockFunction if is_async else MockFunction
+            members.append((name, mock_class, None))
+        else:
+            mock_class = AsyncSpecMockFunction if is_async else SpecMockFunction
+            members.append((name, mock_class, SignatureChecker(signature)))
+    return tuple(members)
+
+def _takes_self(static, value):
+    """
+    Returns true if a member of a class, as found in the class
+    __dict__ and as found by getattr, is an instance method whose
+    signature starts with self.
+    """
+    if isinstance(static, (staticmethod, classmethod)):
+        return False
+    if getattr(value, '__self__', None) is not None:
+        # Already bound, like a classmethod implemented in C.
+        return False
+    return inspect.isfunction(static) or inspect.ismethoddescriptor(static)
+
+def spec_object(context, name, spec, **kwargs):
+    """
+    Makes a MockObject with a mock function for each of the methods
+    of a class, or the functions of a module (see spec_members).
+    Keyword arguments set other attributes, or replace the mock
+    functions that would have been made.
+    """
+    for (member, mock_class, checker) in spec_members(spec):
+        if member in kwargs:
+            continue
+        fcn_name = name + '.' + member
+        if checker is None:
+            kwargs[member] = mock_class(context, fcn_name)
+        else:
+            kwargs[member] = mock_class(context, fcn_name, checker)
+    return MockObject(context, name, (), **kwargs)
+
+class ExpectationScript(object):
+
+    """
+    A sequence of expected calls that is set up once, and then used by
+    many tests.  Make mock functions with mock_fcn or mock_async_fcn,
+    and expect calls on them as usual.  Then, in each test, bind the
+    script to the test's CallContext.
+
+    Binding doesn't copy the script.  The context reads the expected
+    calls from it as they are needed, like a cassette, so binding a
+    script with thousands of calls costs about the same as binding
+    one with a single call.  The ExpectedCall objects are shared by
+    all of the tests, except for the ones that change when they are
+    matched: calls that repeat, and calls with an AnyValue.  Those are
+    copied when the test reaches them, so each test has its own
+    counts and its own AnyValue captures.
+
+    In an UNORDERED context, the calls to each function can happen in
+    any order, as if they had been expected one at a time, so binding
+    copies the list of calls into the context instead.
+
+    The script can't be changed after it is first bound.  Because the
+    mock functions are moved to each new context as it is bound, a
+    script should only be used by one test at a time.
+    """
+
+    def __init__(self, name = 'script'):
+        self.name = name
+        self._context = CallContext()
+        self._functions = []
+        # After the script is frozen, these are the expected calls,
+        # as (call, needs_copy) pairs: all of them in order, and
+        # grouped by mock function.
+        self._entries = None
+        self._entries_by_function = None
+
+    def mock_fcn(self, name):
+        """
+        Makes a new MockFunction that is part of this script.
+        """
+        return self._add_function(MockFunction(self._context, name))
+
+    def mock_async_fcn(self, name):
+        """
+        Makes a new AsyncMockFunction that is part of this script.
+        """
+        return self._add_function(AsyncMockFunction(self._context, name))
+
+    def _add_function(self, fcn):
+        if self._entries is not None:
+            raise Exception("script %s has already been bound" % self.name)
+        self._functions.append(fcn)
+        return fcn
+
+    def _freeze(self):
+        entries = []
+        entries_by_function = {}
+        for call in self._context._calls:
+            if type(call) is not ExpectedCall:
+                raise Exception(
+                    "script %s can only hold single expected calls" %
+                    self.name
+                    )
+            return_value = call.return_value
+            if type(return_value) is LazyReturn and return_value.stateful:
+                raise Exception(
+                    "script %s can't return values from an iterator, "
+                    "because it is shared between tests" % self.name
+                    )
+            needs_copy = call.max_count != 1 or call.has_any_value()
+            entries.append((call, needs_copy))
+            entries_by_function.setdefault(call.fcn, []).append(
+                (call, needs_copy)
+                )
+        self._entries = tuple(entries)
+        self._entries_by_function = dict(
+            (fcn, tuple(fcn_entries))
+            for (fcn, fcn_entries) in entries_by_function.items()
+            )
+        self._context = None
+
+    def bind(self, context):
+        """
+        Expects the calls in this script in the given context, and
+        moves the script's mock functions to that context, so that
+        more calls can be expected on them for just this test.
+        Returns a ScriptBinding, which has the test's AnyValue
+        captures.
+        """
+        if self._entries is None:
+            self._freeze()
+        binding = ScriptBinding()
+        for fcn in self._functions:
+            fcn._context = context
+        description = 'script %s' % self.name
+        if context._ordering == ORDERED:
+            if len(self._entries) != 0:
+                context.expect_stream(
+                    self._entries[0][0].fcn,
+                    binding.calls(self._entries),
+                    description
+                    )
+        elif context._ordering == UNORDERED:
+            for call in binding.calls(self._entries):
+                context.expect_call(call.fcn, call)
+        else:
+            for (fcn, entries) in self._entries_by_function.items():
+                context.expect_stream(
+                    fcn,
+                    binding.calls(entries),
+                    description
+                    )
+        return binding
+
+class ScriptBinding(object):
+
+    """
+    One test's use of an ExpectationScript.  It keeps the copies of
+    the script's AnyValue objects that capture this test's values.
+    """
+
+    def __init__(self):
+        self._any_values = {}
+
+    def calls(self, entries):
+        """
+        Generates the expected calls for this test, copying the ones
+        that it can't share with other tests.
+        """
+        any_values = self._any_values
+        for (call, needs_copy) in entries:
+            if needs_copy:
+                call = call.copy(any_values)
+            yield call
+
+    def value(self, any_value):
+        """
+        Returns the value captured in this test by an AnyValue that
+        was used in the script, or None if it hasn't matched yet.
+        """
+        copy = self._any_values.get(any_value)
+        if copy is None:
+            return None
+        return copy.value
+
+class TestCase(unittest.TestCase):
+
+    """
+    Subclass of unittest.TestCase that checks to make sure that all
+    expected function calls have happened.  If you use self.mock_fcn()
+    and self.mock_obj() to make your mocks, then you don't have to
+    worry about calling check_done on them.
+
+    You do need to make sure that if you implement setUp() and
+    tearDown() methods that you call super.
+
+    By default, all expected calls must happen in exactly the order
+    they were expected.  Subclasses can set call_ordering to
+    PER_FUNCTION or UNORDERED to relax that.
+
+    Failure messages list every completed call.  Long-running tests
+    can set call_history_size to remember only that many of the most
+    recent calls, or to 0 to remember just how many there were.
+    Tests that pass large arguments can set fingerprint_call_history,
+    so that the history keeps short fingerprints of them instead.
+
+    If the code under test calls mocks from other threads, set
+    thread_safe_calls.  Failures on those threads are then reported
+    by tearDown even if the thread swallowed the exception.
+
+    To find out which mocks a slow test spends its time in, set
+    collect_call_statistics.  The statistics are passed to
+    report_call_statistics at the end of the test.
+
+    Fields that every test in the class patches can be listed in
+    class_patches instead, as (obj, field, value) tuples like the
+    ones given to PatchSet.  They are patched once, before the first
+    test, and restored after the last.  See module_patches for doing
+    the same for a whole module of tests.
+    """
+
+    call_ordering = ORDERED
+    call_history_size = None
+    thread_safe_calls = False
+    collect_call_statistics = False
+    fingerprint_call_history = False
+    class_patches = ()
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Applies class_patches, which stay in place for all of the tests
+        in the class.  They are restored by a class cleanup, which
+        runs after tearDownClass, and runs even if a subclass's
+        setUpClass fails after this.
+        """
+        super(TestCase, cls).setUpClass()
+        if len(cls.class_patches) != 0:
+            patch_set = PatchSet(*cls.class_patches)
+            patch_set.__enter__()
+            cls.addClassCleanup(patch_set.__exit__, None, None, None)
+
+    def setUp(self):
+        """
+        Get ready to make mock objects.
+        """
+        super(TestCase, self).setUp()
+        self._context = CallContext(
+            ordering = self.call_ordering,
+            history_size = self.call_history_size,
+            thread_safe = self.thread_safe_calls,
+            statistics = self.collect_call_statistics,
+            fingerprint_history = self.fingerprint_call_history
+            )
+
+    def tearDown(self):
+        """
+        Make sure that all of the expected things happened.
+        """
+        super(TestCase, self).tearDown()
+        if self._context.statistics is not None:
+            self.report_call_statistics(self._context.statistics)
+        self._context.check_done()
+
+    def call_statistics(self):
+        """
+        Returns the CallStatistics for the mock functions in this
+        test, or None if collect_call_statistics isn't set.
+        """
+        return self._context.statistics
+
+    def report_call_statistics(self, statistics):
+        """
+        Called at the end of the test with its CallStatistics, when
+        collect_call_statistics is set.  Writes them to stderr;
+        override this to send them somewhere else.
+        """
+        sys.stderr.write('\n%s\n%s\n' % (self.id(), statistics))
+
+    def mock_fcn(self, name):
+        """
+        Make a new MockFunction.  It's check_done method will be
+        called at the end of the test.
+        """
+        return MockFunction(self._context, name)
+
+    def mock_async_fcn(self, name):
+        """
+        Make a new AsyncMockFunction.  It's check_done method will be
+        called at the end of the test.
+        """
+        return AsyncMockFunction(self._context, name)
+
+    def run_async(self, coroutine, clock = None):
+        """
+        Runs a coroutine to completion on a new VirtualTimeEventLoop,
+        and returns its result.  The loop uses the given VirtualClock,
+        or a new one.
+        """
+        loop = VirtualTimeEventLoop(clock)
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def record(self, fcn, path):
+        """
+        Make a new Recorder for the real function, writing to the
+        cassette file at path.  It is closed at the end of the test.
+        """
+        recorder = Recorder(fcn, path)
+        self.addCleanup(recorder.close)
+        return recorder
+
+    def mock_obj(self, name, methods = [], **kwargs):
+        """
+        Make a new MockObject.
+        """
+        return MockObject(self._context, name, methods, **kwargs)
+
+    def bind_script(self, script):
+        """
+        Expects the calls in an ExpectationScript in this test.
+        Returns the ScriptBinding, which has the values captured by
+        the script's AnyValue objects.
+        """
+        return script.bind(self._context)
+
+    def in_order(self):
+        """
+        Returns a context for a with statement, in which the expected
+        calls have to happen in order.  See CallContext.in_order.
+        """
+        return self._context.in_order()
+
+    def any_order(self):
+        """
+        Returns a context for a with statement, in which the expected
+        calls can happen in any order.  See CallContext.any_order.
+        """
+        return self._context.any_order()
+
+    def mock_spec(self, name, spec, **kwargs):
+        """
+        Make a new MockObject that has a mock function for each
+        method of the given class, or each function of the given
+        module.  Expected and actual calls are checked against the
+        real signatures.
+        """
+        return spec_object(self._context, name, spec, **kwargs)
+
+    def patch(self, obj, field, value):
+        """
+        Convenience method to make Patch objects.
+        """
+        return Patch(obj, field, value)
+
+    def patch_set(self, *patch_tuples):
+        """
+        Convenience method to make PatchSet objects.
+        """
+        return PatchSet(*patch_tuples)
+
+    def virtual_clock(self, *modules):
+        """
+        Convenience method to make VirtualClock objects.
+        """
+        return VirtualClock(modules)
+
+def module_patches(*patch_tuples):
+    """
+    Returns setUpModule and tearDownModule functions that patch the
+    given fields for all of the tests in a module.  Each patch_tuple
+    is (obj, field, value), as for PatchSet.  Use it like this at the
+    top level of a test module:
+
+        setUpModule, tearDownModule = tinymock.module_patches(
+            (time, 'sleep', fake_sleep),
+            (socket, 'create_connection', fake_connect)
+            )
+    """
+    patch_set = PatchSet(*patch_tuples)
+    def setUpModule():
+        patch_set.__enter__()
+    def tearDownModule():
+        patch_set.__exit__(None, None, None)
+    return (setUpModule, tearDownModule)
+
+# Stands for a field that wasn't there before it was patched.  (None
+# can't be used for that, because it's a value that fields can have.)
+_ABSENT = object()
+
+class Patch(object):
+
+    """
+    A context for use in a with statement to temporarily replace a
+    member of a module or object with a new value.
+    """
+
+    def __init__(self, obj, field, value):
+        """
+        Creates a new context.  The named field of the module or
+        object will be replaced with the given value just for the
+        duration of the context.
+        """
+        self._object = obj
+        self._field = field
+        self._value = value
+
+    def __enter__(self):
+        # We get the previous value through the __dict__ rather than using
+        # getattr, since getattr transforms static and class methods into
+        # functions and bound methods, respectively.  We just want the raw
+        # value so that we can restore it easily on context exit.
+        self._prev_value = self._object.__dict__.get(self._field, _ABSENT)
+        setattr(self._object, self._field, self._value)
+
+    def __exit__(self, *args):
+        if self._prev_value is _ABSENT:
+            delattr(self._object, self._field)
+        else:
+            setattr(self._object, self._field, self._prev_value)
+
+class PatchSet(object):
+
+    """
+    A context for use in a with statement to apply multiple Patches (see above)
+    at once.  Each patch is specified as a 3-tuple corresponding to the
+    arguments of Patch.
+    """
+
+    def __init__(self, *patch_tuples):
+        """
+        Creates a new context.  Each patch_tuple should be a 3-tuple
+        corresponding to the arguments of Patch.  For example:
+
+            with PatchSet(
+                    (time, 'sleep', sleep),
+                    (time, 'clock', clock)
+                    ):
+                run_with_patched_time()
+
+        is largely equivalent to:
+        
+            with Patch(time, 'sleep', sleep):
+                with Patch(time, 'clock', clock):
+                    run_with_patched_time()
+        """
+        self._patches = [
+                Patch(patch_tuple[0], patch_tuple[1], patch_tuple[2])
+                for patch_tuple in patch_tuples
+                ]
+
+    def __enter__(self):
+        for (i, patch) in enumerate(self._patches):
+            try:
+                patch.__enter__()
+            except BaseException:
+                self._restore(self._patches[:i], sys.exc_info())
+                raise
+
+    def __exit__(self, *args):
+        self._restore(self._patches, args)
+
+    def _restore(self, patches, exc_info):
+        # Patches are undone in the reverse order, so that a field that
+        # was patched twice ends up with its original value.  Every
+        # patch is undone even if one of them fails.
+        error = None
+        for patch in reversed(patches):
+            try:
+                patch.__exit__(*exc_info)
+            except Exception as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        
+# The functions in the time module that a VirtualClock replaces.
+CLOCK_FUNCTIONS = """
+    time time_ns monotonic monotonic_ns perf_counter perf_counter_ns sleep
+    """
+
+class VirtualClock(object):
+
+    """
+    A simulated clock for code that sleeps, times out, or backs off.
+    Used as the context for a with statement, it replaces sleep() and
+    the clock functions in the time module.  Sleeping moves the clock
+    forward immediately, without waiting, and the clock never moves
+    otherwise.
+
+    Modules that imported the functions directly ("from time import
+    sleep") can be passed in too, and their copies are replaced as
+    well.
+    """
+
+    def __init__(self, modules = (), start_time = None):
+        """
+        Creates a new clock.  time.time() starts out at start_time,
+        which defaults to the real time now.  The monotonic clocks
+        start at 0.
+        """
+        if start_time is None:
+            start_time = time.time()
+        self._start_time = start_time
+        self._modules = tuple(modules)
+        self.now = 0.0
+        self.sleeps = []
+        self._patch_set = None
+
+    def advance(self, seconds):
+        """
+        Moves the clock forward.
+        """
+        if seconds < 0:
+            raise ValueError("the clock can't go backwards")
+        self.now += seconds
+
+    def sleep(self, seconds):
+        if seconds < 0:
+            raise ValueError("sleep length must be non-negative")
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def time(self):
+        return self._start_time + self.now
+
+    def time_ns(self):
+        return int(self.time() * 1e9)
+
+    def monotonic(self):
+        return self.now
+
+    def monotonic_ns(self):
+        return int(self.now * 1e9)
+
+    perf_counter = monotonic
+    perf_counter_ns = monotonic_ns
+
+    def patch_set(self):
+        """
+        Returns a PatchSet that replaces the clock functions in the
+        time module, and any copies of them in the other modules given
+        to the constructor.
+        """
+        patch_tuples = []
+        for name in CLOCK_FUNCTIONS.split():
+            real_fcn = getattr(time, name, None)
+            if real_fcn is None:
+                continue
+            patch_tuples.append((time, name, getattr(self, name)))
+            for module in self._modules:
+                if module.__dict__.get(name) is real_fcn:
+                    patch_tuples.append((module, name, getattr(self, name)))
+        return PatchSet(*patch_tuples)
+
+    def __enter__(self):
+        self._patch_set = self.patch_set()
+        self._patch_set.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self._patch_set.__exit__(*args)
+        self._patch_set = None
+
+# The first record in every cassette file.
+CASSETTE_HEADER = ('tinymock cassette', 1)
+
+class Recorder(object):
+
+    """
+    Wraps a real function, and records every call to it in a cassette
+    file.  A mock function can later replay the calls with
+    expect_cassette.
+
+    Each call is stored as a separate pickle of the arguments, the
+    keyword arguments, and the return value or exception, so the file
+    can be written and read one call at a time.  Cassettes are pickle
+    files, so only replay cassettes you trust.
+    """
+
+    def __init__(self, fcn, path):
+        self._fcn = fcn
+        self._file = open(path, 'wb')
+        self._dump(CASSETTE_HEADER)
+
+    def __call__(self, *args, **kwargs):
+        try:
+            result = self._fcn(*args, **kwargs)
+        except Exception as e:
+            self._dump((args, kwargs, None, e))
+            raise
+        self._dump((args, kwargs, result, None))
+        return result
+
+    def _dump(self, record):
+        pickle.dump(record, self._file, pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _cassette_calls(fcn, path):
+    """
+    Generates the expected calls recorded in a cassette file.
+    """
+    with open(path, 'rb') as f:
+        if pickle.load(f) != CASSETTE_HEADER:
+            raise MockException("%s is not a tinymock cassette" % path)
+        while True:
+            try:
+                (args, kwargs, return_value, exception) = pickle.load(f)
+            except EOFError:
+                return
+            call = ExpectedCall(fcn, _wrap_arrays(args), _wrap_arrays(kwargs))
+            call.return_value = return_value
+            call.exception = exception
+            yield call
+
+class TestMock(TestCase):
+
+    def test_function_return_value(self):
+        f = self.mock_fcn('f').expect().returns(2)
+        self.assertEquals(2, f())
+
+    def test_function_raises(self):
+        f = self.mock_fcn('f').expect(2).raises(OSError('kaboom'))
+        def should_raise():
+            f(2)
+        self.assertRaises(OSError, should_raise)
+
+    def test_function_arg_mismatch(self):
+        f = self.mock_fcn('f').expect(1)
+        def should_raise():
+            f(2)
+        self.assertRaises(MockException, should_raise)
+
+    def test_function_arg_match(self):
+        any_arg = AnyValue()
+        f = self.mock_fcn('f').expect(1, any_arg)
+        f(1, 10)
+        self.assertEquals(10, any_arg.value)
+
+    def test_predicate_matcher(self):
+        f = self.mock_fcn('f').expect(Predicate(lambda x: x % 2 == 0, 'even'))
+        f(4)
+        f.expect(Predicate(lambda x: x % 2 == 0, 'even'))
+        self.assertRaises(MockException, f, 3)
+
+    def test_instance_of_matcher(self):
+        f = self.mock_fcn('f').expect(1, InstanceOf(str, bytes)).returns(2)
+        self.assertEqual(2, f(1, 'x'))
+        f.expect(1, InstanceOf(str))
+        self.assertRaises(MockException, f, 1, 2)
+
+    def test_approx_matcher(self):
+        f = self.mock_fcn('f').expect(x = Approx(0.3)).returns(1)
+        self.assertEqual(1, f(x = 0.1 + 0.2))
+        f.expect(Approx(1.0, abs_tol = 0.01))
+        self.assertRaises(MockException, f, 1.1)
+
+    def test_custom_matcher(self):
+        class Even(Matcher):
+            def matches(self, value):
+                return value % 2 == 0
+            def __repr__(self):
+                return '<Even>'
+        f = self.mock_fcn('f').expect(Even(), 1)
+        try:
+            f(2, 2)
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual(
+                'Argument mismatch\n\nCompleted calls:\n\nActual call:\nf(2, 2)\n\nExpected calls:\nf(<Even>, 1)',
+                str(e)
+                )
+
+    def test_compact_records(self):
+        f = self.mock_fcn('f').expect(AnyValue()).returns(1)
+        call = self._context._calls[0]
+        for obj in [f, call, call.args[0]]:
+            self.assertFalse(hasattr(obj, '__dict__'))
+        self.assertEqual('f', f.name)
+        self.assertEqual(1, call.return_value)
+        self.assertEqual(None, call.exception)
+        f(2)
+        self.assertEqual(2, call.args[0].value)
+
+    def test_function_keyword(self):
+        any_arg = AnyValue()
+        f = self.mock_fcn('f').expect(a = 5, b = any_arg)
+        f(a = 5, b = 'x')
+        self.assertEquals('x', any_arg.value)
+
+    def test_function_extra_keyword(self):
+        f = self.mock_fcn('f').expect()
+        def should_raise():
+            f(a = 5)
+        self.assertRaises(MockException, should_raise)
+
+    def test_function_other_keyword(self):
+        f = self.mock_fcn('f').expect(a = 5)
+        def should_raise():
+            f(b = 5)
+        self.assertRaises(MockException, should_raise)
+
+    def test_context_call(self):
+        f = self.mock_fcn('f').expect(1, a = 2).returns(3)
+        self.assertEqual(3, self._context.call(f, 1, a = 2))
+
+    def test_function_not_called(self):
+        f = self.mock_fcn('f').expect()
+        self.assertRaises(MockException, self.tearDown)
+        self._context._calls = []
+
+    def test_function_called_too_many_times(self):
+        f = self.mock_fcn('f').expect()
+        f()
+        def should_raise():
+            f()
+        self.assertRaises(MockException, should_raise)
+    
+    def test_function_called_twice(self):
+        f = self.mock_fcn('f').expect().returns(1)
+        f.expect().returns(2)
+        self.assertEqual(1, f())
+        self.assertEqual(2, f())
+
+    def test_many_expected_calls(self):
+        f = self.mock_fcn('f')
+        for i in range(1000):
+            f.expect(i).returns(i * 2)
+        for i in range(1000):
+            self.assertEqual(i * 2, f(i))
+
+    def test_return_set_on_last_of_many(self):
+        f = self.mock_fcn('f').expect(1).expect(2).returns('b')
+        self.assertEqual(None, f(1))
+        self.assertEqual('b', f(2))
+
+    def test_times(self):
+        f = self.mock_fcn('f').expect(1).returns(2).times(3)
+        g = self.mock_fcn('g').expect()
+        self.assertEqual([2, 2, 2], [f(1), f(1), f(1)])
+        g()
+        self.assertEqual(2, len(self._context._completed_calls))
+
+    def test_times_too_few(self):
+        f = self.mock_fcn('f').expect(1).times(3)
+        f(1)
+        f(1)
+        try:
+            self._context.check_done()
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual(
+                'Still expecting more function calls\n\nCompleted calls:\nf(1) [3 times, called 2]\n\nExpected calls:\nf(1) [3 times, called 2]',
+                str(e)
+                )
+
+    def test_times_too_many(self):
+        f = self.mock_fcn('f').expect(1).times(2)
+        f(1)
+        f(1)
+        self.assertRaises(MockException, f, 1)
+
+    def test_at_least(self):
+        f = self.mock_fcn('f').expect(1).at_least(2)
+        g = self.mock_fcn('g').expect()
+        f(1)
+        self.assertRaises(MockException, g)
+        f = self.mock_fcn('f').expect(1).at_least(2)
+        g = self.mock_fcn('g').expect()
+        for i in range(5):
+            f(1)
+        g()
+
+    def test_any_number(self):
+        f = self.mock_fcn('f').expect(1).any_number()
+        g = self.mock_fcn('g').expect()
+        self.assertEqual('f(1) [any number of times]', str(self._context._calls[0]))
+        g()
+
+    def test_history_size(self):
+        context = CallContext(history_size = 2)
+        f = MockFunction(context, 'f')
+        for i in range(5):
+            f.expect(i)
+            f(i)
+        f.expect(10)
+        try:
+            f(11)
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual(
+                'Argument mismatch\n\nCompleted calls:\n(3 earlier calls not shown)\nf(3)\nf(4)\n\nActual call:\nf(11)\n\nExpected calls:\nf(10)',
+                str(e)
+                )
+
+    def test_history_count_only(self):
+        context = CallContext(history_size = 0)
+        f = MockFunction(context, 'f').expect(1).expect(2)
+        f(1)
+        self.assertEqual(0, len(context._completed_calls))
+        try:
+            context.check_done()
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual(
+                'Still expecting more function calls\n\nCompleted calls:\n(1 earlier calls not shown)\n\nExpected calls:\nf(2)',
+                str(e)
+                )
+
+    def test_mock_object(self):
+        x = self.mock_obj('x', ['foo'])
+        x.foo.expect().returns(1)
+        self.assertEquals(1, x.foo())
+    
+    def test_mock_object_only_mocked_builtins(self):
+        x = self.mock_obj('x', ['__len__'])
+        y = self.mock_obj('y', ['__iter__'])
+        z = self.mock_obj('z')
+        self.assertTrue(hasattr(x, '__len__'))
+        self.assertFalse(hasattr(x, '__iter__'))
+        self.assertFalse(hasattr(y, '__len__'))
+        self.assertFalse(hasattr(z, '__len__'))
+        self.assertTrue(isinstance(x, MockObject))
+        self.assertTrue(type(z) is MockObject)
+        self.assertTrue(type(x) is type(self.mock_obj('w', ['__len__'])))
+        self.assertEqual(hash(z), hash(z))
+
+    def test_mock_object_builtin_set_later(self):
+        x = self.mock_obj('x', ['__len__'])
+        x.__getitem__ = self.mock_fcn('x.__getitem__')
+        x.__len__.expect().returns(3)
+        x.__getitem__.expect(1).returns(2)
+        self.assertEqual(3, len(x))
+        self.assertEqual(2, x[1])
+
+    def test_mock_object_cycles_are_collected(self):
+        import gc
+        refs = []
+        for i in range(10000):
+            a = MockObject(self._context, 'a', [])
+            b = MockObject(self._context, 'b', [], a = a)
+            a.b = b
+            refs.append(weakref.ref(a))
+            refs.append(weakref.ref(b))
+        del a, b
+        gc.collect()
+        self.assertEqual([], gc.garbage)
+        self.assertEqual([], [ref for ref in refs if ref() is not None])
+
+    def test_mock_object_name_not_in_dict(self):
+        x = self.mock_obj('x', _mock_name = 'shadowed')
+        self.assertEqual('<MockObject x>', repr(x))
+
+    def test_mock_object_with_kw_args(self):
+        x = self.mock_obj(
+            'x',
+            foo = self.mock_fcn('f').expect().returns(1),
+            bar = 2
+            )
+        self.assertEquals(1, x.foo())
+        self.assertEquals(2, x.bar)
+
+    def test_mock_object_builtin_methods(self):
+        x = self.mock_obj(
+            'x',
+            __hash__ = self.mock_fcn('__hash__'),
+            __getitem__ = self.mock_fcn('__getitem__'),
+            __add__ = self.mock_fcn('__add__')
+            )
+        x.__hash__.expect().returns(1)
+        x.__getitem__.expect(1).returns(2)
+        x.__add__.expect(1).returns(3)
+        self.assertEquals(1, hash(x))
+        self.assertEquals(2, x[1])
+        self.assertEquals(3, x + 1)
+
+    def test_patch(self):
+        import time
+        _sleep = self.mock_fcn('sleep')
+        _sleep.expect(1).returns(2)
+        with self.patch(time, 'sleep', _sleep):
+            self.assertEquals(2, time.sleep(1))
+
+    def test_patch_method(self):
+        import time
+        with self.patch(
+                time,
+                'sleep',
+                self.mock_fcn('sleep').expect(1).returns(2)
+                ):
+            self.assertEquals(2, time.sleep(1))
+
+    def test_static_method_patch(self):
+        class DummyClass(object):
+            @staticmethod
+            def be_smart(x):
+                return x
+        be_smart = self.mock_fcn('be_smart').expect(1).returns(2)
+        with self.patch(DummyClass, 'be_smart', staticmethod(be_smart)):
+            self.assertEquals(2, DummyClass.be_smart(1))
+        self.assertEquals(0, DummyClass.be_smart(0))
+
+    def test_class_method_patch(self):
+        class DummyClass(object):
+            @classmethod
+            def be_smart(cls, x):
+                return x
+        be_smart = self.mock_fcn('be_smart').expect(DummyClass, 1).returns(2)
+        with self.patch(DummyClass, 'be_smart', classmethod(be_smart)):
+            self.assertEquals(2, DummyClass.be_smart(1))
+        self.assertEquals(0, DummyClass.be_smart(0))
+
+    def test_patch_non_existant(self):
+        import time
+        with self.patch(
+                time,
+                'duerme',
+                self.mock_fcn('duerme').expect(1).returns(2)
+                ):
+            self.assertEquals(2, time.duerme(1))
+
+    def test_patch_restores_none(self):
+        class DummyClass(object):
+            value = None
+        with self.patch(DummyClass, 'value', 1):
+            self.assertEqual(1, DummyClass.value)
+        self.assertEqual(None, DummyClass.__dict__['value'])
+
+    def test_patch_set_same_field_twice(self):
+        class DummyClass(object):
+            value = 0
+        with self.patch_set(
+                (DummyClass, 'value', 1),
+                (DummyClass, 'value', 2)
+                ):
+            self.assertEqual(2, DummyClass.value)
+        self.assertEqual(0, DummyClass.value)
+
+    def test_patch_set_undone_on_failure(self):
+        class DummyClass(object):
+            value = 0
+        patches = self.patch_set(
+            (DummyClass, 'value', 1),
+            (None, 'value', 2)
+            )
+        def should_raise():
+            with patches:
+                pass
+        self.assertRaises(AttributeError, should_raise)
+        self.assertEqual(0, DummyClass.value)
+
+    def test_patch_set(self):
+        class Person():
+            def __init__(self, name):
+                self.name = name
+        p1 = Person('Joe')
+        p2 = Person('Fred')
+        with PatchSet(
+                (p1, 'name', 'Sally'),
+                (p2, 'age', 37)
+                ):
+            self.assertEquals(dict(name = 'Sally'), p1.__dict__)
+            self.assertEquals(dict(name = 'Fred', age = 37), p2.__dict__)
+        self.assertEquals(dict(name = 'Joe'), p1.__dict__)
+        self.assertEquals(dict(name = 'Fred'), p2.__dict__)
+
+    def test_patch_set_method(self):
+        class Person():
+            def __init__(self, name):
+                self.name = name
+        p1 = Person('Joe')
+        p2 = Person('Fred')
+        with self.patch_set(
+                (p1, 'name', 'Sally'),
+                (p2, 'age', 37)
+                ):
+            self.assertEquals(dict(name = 'Sally'), p1.__dict__)
+            self.assertEquals(dict(name = 'Fred', age = 37), p2.__dict__)
+        self.assertEquals(dict(name = 'Joe'), p1.__dict__)
+        self.assertEquals(dict(name = 'Fred'), p2.__dict__)
+
+    def test_sleeper(self):
+        import time
+        import os
+        sleep = self.mock_fcn("sleep").expect(10)
+        getpid = self.mock_fcn("getpid").expect().returns(1)
+        patches = self.patch_set(
+            (time, "sleep", sleep),
+            (os, "getpid", getpid)
+            )
+        with patches:
+            time.sleep(10)
+            self.assertEquals(1, os.getpid())
+
+    def test_no_such_attr(self):
+        x = self.mock_obj('x')
+        def should_raise():
+            x.foo
+        self.assertRaises(MockException, should_raise)
+
+    def test_no_such_method(self):
+        x = self.mock_obj('x')
+        def should_raise():
+            x.foo()
+        self.assertRaises(MockException, should_raise)
+
+    def test_call_history(self):
+        double = self.mock_fcn('double')
+        car = self.mock_obj('car', ['drive', 'stop'])
+        car.drive.expect('60mph').returns(True)
+        double.expect(2).returns(4)
+        car.stop.expect().raises(OSError('ack'))
+        car.drive('60mph')
+        try:
+            double(3)
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual(
+                "Argument mismatch\n\nCompleted calls:\ncar.drive('60mph') returns True\n\nActual call:\ndouble(3)\n\nExpected calls:\ndouble(2) returns 4\ncar.stop() raises OSError('ack',)",
+                e.message
+                )
+
+    def test_failure_message_is_lazy(self):
+        class Unprintable(object):
+            def __repr__(self):
+                raise AssertionError('should not be rendered')
+        f = self.mock_fcn('f').expect(Unprintable())
+        try:
+            f(2)
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual('Argument mismatch', e.args[0])
+
+    def test_failure_message_is_bounded(self):
+        f = self.mock_fcn('f')
+        f.expect(b'x' * 1000000)
+        for i in range(MAX_REPORTED_CALLS + 1233):
+            f.expect(i)
+        try:
+            f(b'y')
+            self.fail('should have thrown')
+        except MockException as e:
+            lines = str(e).split('\n')
+            self.assertEqual(
+                "f(b'" + 'x' * MAX_REPR_LENGTH + "'... (1000000 bytes))",
+                lines[8]
+                )
+            self.assertEqual(MAX_REPORTED_CALLS + 9, len(lines))
+            self.assertEqual('... 1,234 more expected calls', lines[-1])
+
+    def test_mock_obj_as_arg(self):
+        screw = self.mock_obj('screw')
+        nail = self.mock_obj('nail')
+        hammer = self.mock_obj('hammer', ['pound'])
+        hammer.pound.expect(nail)
+        hammer.pound.expect(nail)
+        hammer.pound(nail)
+        try:
+            hammer.pound(screw)
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual(
+                'Argument mismatch\n\nCompleted calls:\nhammer.pound(<MockObject nail>)\n\nActual call:\nhammer.pound(<MockObject screw>)\n\nExpected calls:\nhammer.pound(<MockObject nail>)',
+                e.message
+                )
+
+class Grid(object):
+
+    """
+    A tiny stand-in for a NumPy array, with just the attributes and
+    operators that ArrayEqual and ArrayApprox use.
+    """
+
+    def __init__(self, values, shape = None):
+        self.values = list(values)
+        self.shape = (len(self.values),) if shape is None else shape
+
+    def _each(self, fcn, other):
+        if isinstance(other, Grid):
+            others = other.values
+        else:
+            others = [other] * len(self.values)
+        return Grid(map(fcn, self.values, others), self.shape)
+
+    def __ne__(self, other):
+        return self._each(lambda a, b: a != b, other)
+
+    def __le__(self, other):
+        return self._each(lambda a, b: a <= b, other)
+
+    def __sub__(self, other):
+        return self._each(lambda a, b: a - b, other)
+
+    def __add__(self, other):
+        return self._each(lambda a, b: a + b, other)
+
+    def __mul__(self, other):
+        return self._each(lambda a, b: a * b, other)
+
+    __radd__ = __add__
+    __rmul__ = __mul__
+
+    def __abs__(self):
+        return Grid(map(abs, self.values), self.shape)
+
+    def __invert__(self):
+        return Grid((not value for value in self.values), self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def any(self):
+        return any(self.values)
+
+    def sum(self):
+        return sum(self.values)
+
+    def argmax(self):
+        return self.values.index(max(self.values))
+
+    def ravel(self):
+        return Grid(self.values)
+
+    def __repr__(self):
+        return 'Grid(%r, %r)' % (self.values, self.shape)
+
+class TestBufferMatchers(TestCase):
+
+    def test_buffer_equal(self):
+        data = array.array('i', range(100000))
+        fcn = self.mock_fcn('write').expect(BufferEqual(data)).times(3)
+        fcn(array.array('i', range(100000)))
+        fcn(memoryview(data))
+        fcn(bytes(data))
+
+    def test_bytes(self):
+        fcn = self.mock_fcn('write').expect(BufferEqual(b'abc')).times(2)
+        fcn(bytearray(b'abc'))
+        fcn(b'abc')
+        self.assertFalse(BufferEqual(b'abc').matches(b'abd'))
+        self.assertFalse(BufferEqual(b'abc').matches('abc'))
+
+    def test_non_contiguous(self):
+        data = bytearray(range(10))
+        matcher = BufferEqual(memoryview(data)[::2])
+        self.assertTrue(matcher.matches(bytes(data[::2])))
+
+    def test_first_difference(self):
+        data = bytearray(1000000)
+        fcn = self.mock_fcn('write').expect(BufferEqual(bytes(data)))
+        data[700000] = 7
+        try:
+            fcn(data)
+            self.fail('should have thrown')
+        except MockException as e:
+            message = str(e)
+        self.assertTrue(
+            'argument 0: expected 1,000,000 bytes, got 1,000,000 (sha256 '
+            in message
+            )
+        self.assertTrue(
+            'first difference at offset 700,000: 0x00 != 0x07' in message
+            )
+        self.assertTrue(len(message) < 2000)
+
+    def test_buffer_reused(self):
+        fcn = self.mock_fcn('send').expect(BufferEqual(b'hello'))
+        data = bytearray(b'hellp')
+        try:
+            fcn(data)
+            self.fail('should have thrown')
+        except MockException as e:
+            data[:] = b'reused'
+            message = str(e)
+        self.assertTrue("\nsend(bytearray(b'hellp'))\n" in message)
+        self.assertTrue('0x6f != 0x70' in message)
+
+    def test_shorter(self):
+        matcher = BufferEqual(b'abcdef')
+        self.assertEqual(
+            'expected 6 bytes, got 3 (sha256 %s); '
+            'same up to the end of the shorter one' % _digest(b'abc'),
+            matcher.describe_mismatch(b'abc')
+            )
+
+    def test_repr(self):
+        self.assertEqual(
+            '<BufferEqual 3 bytes, sha256 %s>' % _digest(b'abc'),
+            repr(BufferEqual(bytearray(b'abc')))
+            )
+
+    def test_not_a_buffer(self):
+        self.assertRaises(TypeError, BufferEqual, 'abc')
+
+class FakeNumpy(object):
+
+    """
+    Stands in for the numpy module in TestDuckArrayMatchers.
+    """
+
+    ndarray = Grid
+
+class TestDuckArrayMatchers(TestCase):
+
+    def setUp(self):
+        super(TestDuckArrayMatchers, self).setUp()
+        # Makes _wrap_arrays treat a Grid as a NumPy array.
+        self.saved_numpy = sys.modules.get('numpy')
+        sys.modules['numpy'] = FakeNumpy
+
+    def tearDown(self):
+        if self.saved_numpy is None:
+            del sys.modules['numpy']
+        else:
+            sys.modules['numpy'] = self.saved_numpy
+        super(TestDuckArrayMatchers, self).tearDown()
+
+    def test_array_equal(self):
+        matcher = ArrayEqual(Grid([1, 2, 3, 4], (2, 2)))
+        self.assertTrue(matcher.matches(Grid([1, 2, 3, 4], (2, 2))))
+        self.assertFalse(matcher.matches(Grid([1, 2, 3, 4])))
+        self.assertFalse(matcher.matches([1, 2, 3, 4]))
+        self.assertEqual(
+            '1 of 4 elements differ; first at index (1, 1): '
+            'expected 4, got 5',
+            matcher.describe_mismatch(Grid([1, 2, 3, 5], (2, 2)))
+            )
+        self.assertEqual(
+            'expected shape (2, 2), got (4,)',
+            matcher.describe_mismatch(Grid([1, 2, 3, 4]))
+            )
+
+    def test_array_approx(self):
+        matcher = ArrayApprox(Grid([1.0, 2.0]), rel_tol = 1e-6)
+        self.assertTrue(matcher.matches(Grid([1.0, 2.000001])))
+        self.assertFalse(matcher.matches(Grid([1.0, 2.1])))
+        self.assertFalse(matcher.matches(Grid([1.0, 2.0, 3.0])))
+
+    def test_expect(self):
+        fcn = self.mock_fcn('fit').expect(Grid([1, 2])).returns(1)
+        self.assertEqual(1, fcn(Grid([1, 2])))
+
+    def test_stream(self):
+        fcn = self.mock_fcn('fit').expect_stream(
+            Call(Grid([i, i])).returns(i) for i in range(3)
+            )
+        for i in range(3):
+            self.assertEqual(i, fcn(Grid([i, i])))
+
+    def test_cassette(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = directory + '/cassette'
+        with Recorder(len, path) as recorder:
+            recorder(Grid([1, 2]))
+        fcn = self.mock_fcn('fit').expect_cassette(path)
+        self.assertEqual(2, fcn(Grid([1, 2])))
+
+@unittest.skipIf(
+    importlib.util.find_spec('numpy') is None,
+    'numpy is not installed'
+    )
+class TestArrayMatchers(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestArrayMatchers, cls).setUpClass()
+        global numpy
+        import numpy
+
+    def test_plain_array(self):
+        fcn = self.mock_fcn('fit').expect(numpy.arange(10)).returns(1)
+        self.assertEqual(1, fcn(numpy.arange(10)))
+
+    def test_array_mismatch(self):
+        fcn = self.mock_fcn('fit').expect(numpy.zeros((100, 100)))
+        actual = numpy.zeros((100, 100))
+        actual[3, 4] = 1.5
+        try:
+            fcn(actual)
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertTrue(
+                '1 of 10,000 elements differ; first at index (3, 4): '
+                'expected 0.0, got 1.5' in str(e)
+                )
+
+    def test_array_against_plain_value(self):
+        fcn = self.mock_fcn('fit').expect(3)
+        self.assertRaises(MockException, fcn, numpy.arange(3))
+
+    def test_approx(self):
+        matcher = ArrayApprox(numpy.array([1.0, 2.0]), rel_tol = 1e-6)
+        self.assertTrue(matcher.matches(numpy.array([1.0, 2.000001])))
+        self.assertFalse(matcher.matches(numpy.array([1.0, 2.1])))
+        self.assertFalse(matcher.matches(numpy.array([1.0, 2.0, 3.0])))
+
+class TestVirtualClock(TestCase):
+
+    def test_sleep_advances_time(self):
+        start = time.time()
+        with self.virtual_clock() as clock:
+            before = time.monotonic()
+            time.sleep(3600)
+            self.assertEqual(3600, time.monotonic() - before)
+            self.assertEqual(clock.time(), time.time())
+        self.assertTrue(time.time() - start < 60)
+        self.assertEqual([3600], clock.sleeps)
+
+    def test_backoff(self):
+        def retry(fcn, attempts):
+            delay = 1
+            for i in range(attempts):
+                try:
+                    return fcn()
+                except OSError:
+                    time.sleep(delay)
+                    delay *= 2
+        fcn = self.mock_fcn('fcn')
+        fcn.expect().raises(OSError()).times(3)
+        fcn.expect().returns('ok')
+        with self.virtual_clock() as clock:
+            self.assertEqual('ok', retry(fcn, 5))
+        self.assertEqual([1, 2, 4], clock.sleeps)
+        self.assertEqual(7, clock.monotonic())
+
+    def test_restores_time(self):
+        real_sleep = time.sleep
+        with self.virtual_clock():
+            self.assertNotEqual(real_sleep, time.sleep)
+        self.assertEqual(real_sleep, time.sleep)
+
+    def test_imported_copies(self):
+        import types
+        module = types.ModuleType('fake')
+        module.sleep = time.sleep
+        module.monotonic = lambda: 'not from time'
+        with self.virtual_clock(module) as clock:
+            module.sleep(5)
+            self.assertEqual('not from time', module.monotonic())
+        self.assertEqual(5, clock.now)
+
+    def test_start_time(self):
+        clock = VirtualClock(start_time = 1000)
+        clock.advance(5)
+        self.assertEqual(1005, clock.time())
+        self.assertEqual(5000000000, clock.monotonic_ns())
+        self.assertRaises(ValueError, clock.sleep, -1)
+
+class TestAsync(TestCase):
+
+    def test_return_value(self):
+        fetch = self.mock_async_fcn('fetch').expect('a').returns(1)
+        self.assertEqual(1, self.run_async(fetch('a')))
+
+    def test_raises_on_await(self):
+        fetch = self.mock_async_fcn('fetch').expect('a').raises(OSError())
+        coroutine = fetch('a')
+        self.assertRaises(OSError, self.run_async, coroutine)
+
+    def test_mismatch_on_call(self):
+        fetch = self.mock_async_fcn('fetch').expect('a')
+        self.assertRaises(MockException, fetch, 'b')
+
+    def test_delays_use_virtual_time(self):
+        fetch = self.mock_async_fcn('fetch')
+        for i in range(1000):
+            fetch.expect(i).returns(i * 2).delays(1000 - i)
+        async def run():
+            return await asyncio.gather(*[fetch(i) for i in range(1000)])
+        clock = VirtualClock()
+        start = time.time()
+        result = self.run_async(run(), clock)
+        self.assertEqual([i * 2 for i in range(1000)], result)
+        self.assertTrue(1000 <= clock.monotonic() < 1001)
+        self.assertTrue(time.time() - start < 60)
+
+    def test_timeout(self):
+        fetch = self.mock_async_fcn('fetch').expect().delays(30)
+        async def run():
+            await asyncio.wait_for(fetch(), 10)
+        self.assertRaises(asyncio.TimeoutError, self.run_async, run())
+
+class TestCassette(TestCase):
+
+    def setUp(self):
+        super(TestCassette, self).setUp()
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + '/cassette'
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+        super(TestCassette, self).tearDown()
+
+    def record_divisions(self):
+        def divide(a, b = 1):
+            return a // b
+        with Recorder(divide, self.path) as recorder:
+            for i in range(100):
+                self.assertEqual(i // 3, recorder(i, b = 3))
+            self.assertRaises(ZeroDivisionError, recorder, 1, 0)
+
+    def test_record_and_replay(self):
+        self.record_divisions()
+        divide = self.mock_fcn('divide').expect_cassette(self.path)
+        for i in range(100):
+            self.assertEqual(i // 3, divide(i, b = 3))
+        self.assertRaises(ZeroDivisionError, divide, 1, 0)
+
+    def test_replay_mismatch(self):
+        self.record_divisions()
+        divide = self.mock_fcn('divide').expect_cassette(self.path)
+        divide(0, b = 3)
+        try:
+            divide(2, b = 3)
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual(
+                "Argument mismatch\n\nCompleted calls:\ndivide(0, b = 3) returns 0\n\nActual call:\ndivide(2, b = 3)\n\nExpected calls:\ndivide(1, b = 3) returns 0\n... more calls from cassette '%s', at call 2:\n    1: divide(0, b = 3) returns 0\n -> 2: divide(1, b = 3) returns 0\n    3: divide(2, b = 3) returns 0" % self.path,
+                str(e)
+                )
+
+    def test_replay_is_lazy(self):
+        self.record_divisions()
+        before = self.mock_fcn('before').expect()
+        divide = self.mock_fcn('divide').expect_cassette(self.path)
+        after = self.mock_fcn('after').expect()
+        self.assertEqual(4, self._context._pending_count())
+        before()
+        for i in range(100):
+            divide(i, b = 3)
+        self.assertRaises(ZeroDivisionError, divide, 1, 0)
+        after()
+
+    def test_not_finished(self):
+        self.record_divisions()
+        divide = self.mock_fcn('divide').expect_cassette(self.path)
+        divide(0, b = 3)
+        self.assertRaises(MockException, self._context.check_done)
+
+    def test_record_cleanup(self):
+        recorder = self.record(lambda: 1, self.path)
+        self.assertEqual(1, recorder())
+
+class TestCassetteUnordered(TestCassette):
+
+    call_ordering = UNORDERED
+
+    def test_replay_interleaved(self):
+        self.record_divisions()
+        divide = self.mock_fcn('divide').expect_cassette(self.path)
+        other = self.mock_fcn('other').expect(1).expect(2)
+        other(2)
+        for i in range(50):
+            divide(i, b = 3)
+        other(1)
+        for i in range(50, 100):
+            divide(i, b = 3)
+        self.assertRaises(ZeroDivisionError, divide, 1, 0)
+
+class TestStream(TestCase):
+
+    def test_stream(self):
+        def pages():
+            for i in range(3):
+                yield Call(page = i).returns([i])
+            yield Call(page = 3).raises(StopIteration())
+        fetch = self.mock_fcn('fetch').expect_stream(pages())
+        self.assertEqual([0], fetch(page = 0))
+        self.assertEqual([1], fetch(page = 1))
+        self.assertEqual([2], fetch(page = 2))
+        self.assertRaises(StopIteration, fetch, page = 3)
+
+    def test_constant_memory(self):
+        def messages():
+            for i in itertools.count():
+                yield Call().returns(i)
+        poll = self.mock_fcn('poll').expect_stream(messages())
+        for i in range(100000):
+            self.assertEqual(i, poll())
+            self.assertEqual(2, self._context._pending_count())
+        self._context = CallContext()
+
+    def test_not_consumed(self):
+        def pages():
+            for i in range(10):
+                yield Call(i)
+        fetch = self.mock_fcn('fetch').expect_stream(pages())
+        for i in range(3):
+            fetch(i)
+        try:
+            self._context.check_done()
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual(
+                'Still expecting more function calls '
+                '(stream pages not finished after 3 calls)',
+                e.args[0]
+                )
+
+    def test_window(self):
+        def numbers():
+            for i in itertools.count():
+                yield Call(i)
+        fcn = self.mock_fcn('fcn').expect_stream(numbers(), 'numbers')
+        for i in range(1000):
+            fcn(i)
+        try:
+            fcn(-1)
+            self.fail('should have thrown')
+        except MockException as e:
+            lines = str(e).split('\n')
+        index = lines.index('... more calls from numbers, at call 1,001:')
+        self.assertEqual(
+            [
+                '    996: fcn(995)',
+                '    997: fcn(996)',
+                '    998: fcn(997)',
+                '    999: fcn(998)',
+                '    1,000: fcn(999)',
+                ' -> 1,001: fcn(1000)',
+                '    1,002: fcn(1001)'
+                ],
+            lines[index + 1:]
+            )
+
+    def test_message_does_not_read_ahead(self):
+        made = []
+        def pages():
+            for i in range(10):
+                made.append(i)
+                yield Call(i)
+        fetch = self.mock_fcn('fetch').expect_stream(pages())
+        fetch(0)
+        try:
+            self._context.check_done()
+            self.fail('should have thrown')
+        except MockException as e:
+            str(e)
+        self.assertEqual([0, 1, 2], made)
+
+    def test_empty(self):
+        fcn = self.mock_fcn('fcn').expect(1)
+        fcn.expect_stream([])
+        self.assertRaises(Exception, fcn.returns, 5)
+        self.assertEqual(None, fcn(1))
+
+    def test_not_a_call(self):
+        fcn = self.mock_fcn('fcn')
+        self.assertRaises(TypeError, fcn.expect_stream, [(1, 2)])
+
+class TestLazyReturn(TestCase):
+
+    def test_returns_from(self):
+        made = []
+        def pages():
+            for i in range(1000):
+                made.append(i)
+                yield [i] * 100
+        fetch = self.mock_fcn('fetch')
+        fetch.expect(AnyValue()).returns_from(pages()).times(1000)
+        self.assertEqual([0] * 100, fetch(0))
+        self.assertEqual([0], made)
+        for i in range(1, 1000):
+            self.assertEqual([i] * 100, fetch(i))
+
+    def test_runs_out(self):
+        fetch = self.mock_fcn('fetch')
+        fetch.expect().returns_from([1]).times(2)
+        self.assertEqual(1, fetch())
+        try:
+            fetch()
+            self.fail('should have thrown')
+        except MockException as e:
+            message = str(e)
+        self.assertTrue(message.startswith('Ran out of values from list\n'))
+        self.assertTrue('\nActual call:\nfetch()\n' in message)
+        self.assertRaises(MockException, fetch)
+
+    def test_returns_computed(self):
+        double = self.mock_fcn('double')
+        double.expect(AnyValue()).returns_computed(lambda x: 2 * x).at_least(1)
+        self.assertEqual(4, double(2))
+        self.assertEqual(10, double(5))
+
+    def test_message(self):
+        def make_page(page):
+            return []
+        fetch = self.mock_fcn('fetch').expect(1).returns_computed(make_page)
+        self.assertEqual('fetch(1) returns <computed by make_page>',
+                         str(self._context._calls[0]))
+        fetch(1)
+
+    def test_exception_wins(self):
+        fetch = self.mock_fcn('fetch').expect().returns_from([1])
+        fetch.raises(KeyError())
+        self.assertRaises(KeyError, fetch)
+
+    def test_async(self):
+        fetch = self.mock_async_fcn('fetch')
+        fetch.expect(3).returns_computed(lambda x: x + 1).delays(1)
+        self.assertEqual(4, self.run_async(fetch(3)))
+
+    def test_threads(self):
+        context = CallContext(ordering = UNORDERED, thread_safe = True)
+        fetch = MockFunction(context, 'fetch')
+        fetch.expect().returns_from(iter(range(8000))).times(8000)
+        results = []
+        def worker():
+            results.extend(fetch() for i in range(1000))
+        threads = [threading.Thread(target = worker) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        context.check_done()
+        self.assertEqual(list(range(8000)), sorted(results))
+
+    def test_not_in_script(self):
+        script = ExpectationScript()
+        script.mock_fcn('fetch').expect().returns_from([1])
+        self.assertRaises(Exception, script.bind, CallContext())
+
+class TestCallStatistics(TestCase):
+
+    collect_call_statistics = True
+
+    def report_call_statistics(self, statistics):
+        self.reported = statistics
+
+    def test_counts(self):
+        get = self.mock_fcn('get').expect(1).times(3)
+        put = self.mock_fcn('put').expect(2)
+        for i in range(3):
+            get(1)
+        self.assertRaises(MockException, put, 3)
+        stats = self.call_statistics()
+        self.assertEqual(['get', 'put'], [s.name for s in stats.most_called()])
+        self.assertEqual((3, 3, 0), (stats.get('get').calls,
+                                     stats.get('get').matches,
+                                     stats.get('get').mismatches))
+        self.assertEqual((1, 0, 1), (stats.get('put').calls,
+                                     stats.get('put').matches,
+                                     stats.get('put').mismatches))
+        self.assertEqual(0, stats.get('other').calls)
+        self.assertTrue(0 < stats.get('get').dispatch_time)
+        self.assertTrue(stats.get('get').dispatch_time <= stats.total_time())
+        self.assertEqual(3, len(str(stats).split('\n')))
+
+    def test_repr(self):
+        get = self.mock_fcn('get').expect(1).times(2)
+        get(1)
+        get(1)
+        stats = self.call_statistics().get('get')
+        stats.dispatch_time = 0.0015
+        self.assertEqual(
+            '<FunctionStatistics get: 2 calls, 2 matches, 0 mismatches, 1.500 ms>',
+            repr(stats)
+            )
+
+    def test_virtual_clock(self):
+        fcn = self.mock_fcn('f').expect().times(100)
+        with self.virtual_clock():
+            for i in range(100):
+                fcn()
+        self.assertTrue(0 < self.call_statistics().get('f').dispatch_time)
+
+    def test_same_name(self):
+        self.mock_fcn('f').expect()()
+        self.mock_fcn('f').expect()()
+        self.assertEqual(2, self.call_statistics().get('f').calls)
+
+    def test_reported(self):
+        self.mock_fcn('f').expect()()
+        self.tearDown()
+        self.assertEqual(1, self.reported.get('f').calls)
+
+    def test_async(self):
+        fetch = self.mock_async_fcn('fetch').expect().returns(1)
+        self.assertEqual(1, self.run_async(fetch()))
+        self.assertEqual(1, self.call_statistics().get('fetch').matches)
+
+    def test_disabled(self):
+        context = CallContext()
+        MockFunction(context, 'f').expect()()
+        self.assertEqual(None, context.statistics)
+
+class TestPerFunctionOrder(TestCase):
+
+    call_ordering = PER_FUNCTION
+
+    def test_interleaved_functions(self):
+        get = self.mock_fcn('get').expect('a').returns(1)
+        get.expect('b').returns(2)
+        incr = self.mock_fcn('incr').expect('hits')
+        incr('hits')
+        self.assertEqual(1, get('a'))
+        self.assertEqual(2, get('b'))
+
+    def test_order_within_function(self):
+        get = self.mock_fcn('get').expect('a').expect('b')
+        def should_raise():
+            get('b')
         self.assertRaises(MockException, should_raise)
 
-    def test_function_arg_match(self):
-        any_arg = AnyValue()
-        f = self.mock_fcn('f').expect(1, any_arg)
-        f(1, 10)
-        self.assertEquals(10, any_arg.value)
+    def test_equal_ordering_string(self):
+        for ordering in [ORDERED, PER_FUNCTION, UNORDERED]:
+            context = CallContext(ordering = ''.join(list(ordering)))
+            fcn = MockFunction(context, 'fcn').expect(1).returns(2)
+            self.assertEqual(2, fcn(1))
+            context.check_done()
+
+    def test_not_called(self):
+        self.mock_fcn('get').expect('a')
+        self.mock_fcn('put').expect('b')
+        try:
+            self._context.check_done()
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual(
+                'Still expecting more function calls\n\nCompleted calls:\n\nExpected calls:\nget(\'a\')\nput(\'b\')',
+                str(e)
+                )
+
+class TestUnordered(TestCase):
+
+    call_ordering = UNORDERED
 
-    def test_function_keyword(self):
-        any_arg = AnyValue()
-        f = self.mock_fcn('f').expect(a = 5, b = any_arg)
-        f(a = 5, b = 'x')
-        self.assertEquals('x', any_arg.value)
+    def test_any_order(self):
+        get = self.mock_fcn('get').expect('a').returns(1)
+        get.expect('b').returns(2)
+        self.assertEqual(2, get('b'))
+        self.assertEqual(1, get('a'))
 
-    def test_function_extra_keyword(self):
-        f = self.mock_fcn('f').expect()
+    def test_no_match(self):
+        get = self.mock_fcn('get').expect('a').expect('b')
         def should_raise():
-            f(a = 5)
+            get('c')
         self.assertRaises(MockException, should_raise)
 
-    def test_function_not_called(self):
-        f = self.mock_fcn('f').expect()
-        self.assertRaises(MockException, self.tearDown)
-        self._context._calls = []
+    def test_repeated_in_any_order(self):
+        get = self.mock_fcn('get').expect('a').times(2)
+        get.expect('b')
+        get('a')
+        get('b')
+        get('a')
 
-    def test_function_called_too_many_times(self):
-        f = self.mock_fcn('f').expect()
-        f()
+    def test_many_keys(self):
+        get = self.mock_fcn('cache.get')
+        for i in range(50000):
+            get.expect('key%d' % i).returns(i)
+        for i in reversed(range(50000)):
+            self.assertEqual(i, get('key%d' % i))
+
+    def test_earliest_match_wins(self):
+        any_value = AnyValue()
+        get = self.mock_fcn('get')
+        get.expect('a').returns(1)
+        get.expect(any_value).returns(2)
+        get.expect('b').returns(3)
+        self.assertEqual(1, get('a'))
+        self.assertEqual(None, any_value.value)
+        self.assertEqual(2, get('b'))
+        self.assertEqual('b', any_value.value)
+        self.assertEqual(3, get('b'))
+
+    def test_same_arguments(self):
+        get = self.mock_fcn('get')
+        get.expect('a').returns(1)
+        get.expect('a').returns(2)
+        self.assertEqual(1, get('a'))
+        self.assertEqual(2, get('a'))
+
+    def test_keyword_arguments(self):
+        get = self.mock_fcn('get')
+        get.expect('a', x = 1, y = 2).returns(1)
+        get.expect('a', x = 1).returns(2)
+        self.assertEqual(2, get('a', x = 1))
+        self.assertEqual(1, get('a', y = 2, x = 1))
+
+    def test_unhashable_arguments(self):
+        put = self.mock_fcn('put')
+        put.expect([1]).returns(1)
+        put.expect(frozenset([2])).returns(2)
+        self.assertEqual(2, put(set([2])))
+        self.assertEqual(1, put([1]))
+
+    def test_unhashable_actual_arguments(self):
+        put = self.mock_fcn('put')
+        put.expect(b'ab').returns(1)
+        put.expect('k', {'a': 1}).returns(2)
+        put.expect(bytearray(b'ab')).returns(3)
+        self.assertEqual(2, put('k', {'a': 1}))
+        self.assertEqual(1, put(bytearray(b'ab')))
+        self.assertEqual(3, put(b'ab'))
+
+    def test_mock_object_arguments(self):
+        key = self.mock_obj('key', ['__hash__'])
+        get = self.mock_fcn('get').expect(key).returns(1)
+        get.expect((2, key)).returns(2)
+        self.assertEqual(2, get((2, key)))
+        self.assertEqual(1, get(key))
+
+    def test_mismatch_reports_first_call(self):
+        get = self.mock_fcn('get').expect('a').expect(b = 1)
+        try:
+            get('c')
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual('Argument mismatch', e.args[0])
+
+    def test_unexpected_function(self):
+        self.mock_fcn('get')
+        put = self.mock_fcn('put')
         def should_raise():
-            f()
+            put('c')
         self.assertRaises(MockException, should_raise)
-    
-    def test_function_called_twice(self):
-        f = self.mock_fcn('f').expect().returns(1)
-        f.expect().returns(2)
-        self.assertEqual(1, f())
-        self.assertEqual(2, f())
 
-    def test_mock_object(self):
-        x = self.mock_obj('x', ['foo'])
-        x.foo.expect().returns(1)
-        self.assertEquals(1, x.foo())
-    
-    def test_mock_object_with_kw_args(self):
-        x = self.mock_obj(
-            'x',
-            foo = self.mock_fcn('f').expect().returns(1),
-            bar = 2
+class TestOrderingGroups(TestCase):
+
+    call_ordering = UNORDERED
+
+    def expect_pipeline(self, count):
+        (open_, read, close) = (
+            self.mock_fcn('open'), self.mock_fcn('read'), self.mock_fcn('close')
             )
-        self.assertEquals(1, x.foo())
-        self.assertEquals(2, x.bar)
+        with self.in_order():
+            open_.expect('f')
+            with self.any_order():
+                for i in range(count):
+                    read.expect(i).returns(i)
+            close.expect('f')
+        return (open_, read, close)
 
-    def test_mock_object_builtin_methods(self):
-        x = self.mock_obj(
-            'x',
-            __hash__ = self.mock_fcn('__hash__'),
-            __getitem__ = self.mock_fcn('__getitem__'),
-            __add__ = self.mock_fcn('__add__')
+    def assert_fails(self, message, fcn, *args):
+        try:
+            fcn(*args)
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertEqual(message, e.args[0])
+
+    def test_pipeline(self):
+        (open_, read, close) = self.expect_pipeline(3)
+        open_('f')
+        self.assertEqual(2, read(2))
+        self.assertEqual(0, read(0))
+        self.assertEqual(1, read(1))
+        close('f')
+
+    def test_many(self):
+        (open_, read, close) = self.expect_pipeline(20000)
+        open_('f')
+        for i in reversed(range(20000)):
+            read(i)
+        close('f')
+
+    def test_read_before_open(self):
+        (open_, read, close) = self.expect_pipeline(3)
+        self.assert_fails(
+            "Ordering constraint violated: read(1) returns 1 has to wait for open('f')",
+            read, 1
             )
-        x.__hash__.expect().returns(1)
-        x.__getitem__.expect(1).returns(2)
-        x.__add__.expect(1).returns(3)
-        self.assertEquals(1, hash(x))
-        self.assertEquals(2, x[1])
-        self.assertEquals(3, x + 1)
 
-    def test_patch(self):
-        import time
-        _sleep = self.mock_fcn('sleep')
-        _sleep.expect(1).returns(2)
-        with self.patch(time, 'sleep', _sleep):
-            self.assertEquals(2, time.sleep(1))
+    def test_close_too_soon(self):
+        (open_, read, close) = self.expect_pipeline(3)
+        open_('f')
+        read(0)
+        self.assert_fails(
+            "Ordering constraint violated: close('f') has to wait for read(1) returns 1",
+            close, 'f'
+            )
 
-    def test_patch_method(self):
-        import time
-        with self.patch(
-                time,
-                'sleep',
-                self.mock_fcn('sleep').expect(1).returns(2)
-                ):
-            self.assertEquals(2, time.sleep(1))
+    def test_nested_blocker(self):
+        (a, b, c) = (self.mock_fcn('a'), self.mock_fcn('b'), self.mock_fcn('c'))
+        with self.in_order():
+            a.expect()
+            with self.in_order():
+                b.expect()
+                c.expect()
+        self.assert_fails(
+            'Ordering constraint violated: c() has to wait for a()',
+            c
+            )
 
-    def test_static_method_patch(self):
-        class DummyClass(object):
-            @staticmethod
-            def be_smart(x):
-                return x
-        be_smart = self.mock_fcn('be_smart').expect(1).returns(2)
-        with self.patch(DummyClass, 'be_smart', staticmethod(be_smart)):
-            self.assertEquals(2, DummyClass.be_smart(1))
-        self.assertEquals(0, DummyClass.be_smart(0))
+    def test_optional_and_repeated(self):
+        (poll, close) = (self.mock_fcn('poll'), self.mock_fcn('close'))
+        with self.in_order():
+            poll.expect('skipped').any_number()
+            poll.expect().at_least(1)
+            close.expect()
+        poll()
+        poll()
+        close()
 
-    def test_class_method_patch(self):
-        class DummyClass(object):
-            @classmethod
-            def be_smart(cls, x):
-                return x
-        be_smart = self.mock_fcn('be_smart').expect(DummyClass, 1).returns(2)
-        with self.patch(DummyClass, 'be_smart', classmethod(be_smart)):
-            self.assertEquals(2, DummyClass.be_smart(1))
-        self.assertEquals(0, DummyClass.be_smart(0))
+    def test_repeated_call_retired(self):
+        (a, b) = (self.mock_fcn('a'), self.mock_fcn('b'))
+        with self.in_order():
+            a.expect().at_least(1)
+            b.expect()
+        a()
+        a()
+        b()
+        self.assert_fails('Unexpected call', a)
 
-    def test_patch_non_existant(self):
-        import time
-        with self.patch(
-                time,
-                'duerme',
-                self.mock_fcn('duerme').expect(1).returns(2)
-                ):
-            self.assertEquals(2, time.duerme(1))
+    def test_repeated_call_in_nested_group(self):
+        (a, b, c) = (self.mock_fcn('a'), self.mock_fcn('b'), self.mock_fcn('c'))
+        with self.in_order():
+            with self.any_order():
+                a.expect().at_least(1)
+                b.expect()
+            c.expect()
+        a()
+        b()
+        a()
+        c()
+        self.assert_fails('Unexpected call', a)
 
-    def test_patch_set(self):
-        class Person():
-            def __init__(self, name):
-                self.name = name
-        p1 = Person('Joe')
-        p2 = Person('Fred')
-        with PatchSet(
-                (p1, 'name', 'Sally'),
-                (p2, 'age', 37)
-                ):
-            self.assertEquals(dict(name = 'Sally'), p1.__dict__)
-            self.assertEquals(dict(name = 'Fred', age = 37), p2.__dict__)
-        self.assertEquals(dict(name = 'Joe'), p1.__dict__)
-        self.assertEquals(dict(name = 'Fred'), p2.__dict__)
+    def test_outside_groups(self):
+        (open_, read, close) = self.expect_pipeline(1)
+        other = self.mock_fcn('other').expect()
+        other()
+        open_('f')
+        read(0)
+        close('f')
 
-    def test_patch_set_method(self):
-        class Person():
-            def __init__(self, name):
-                self.name = name
-        p1 = Person('Joe')
-        p2 = Person('Fred')
-        with self.patch_set(
-                (p1, 'name', 'Sally'),
-                (p2, 'age', 37)
-                ):
-            self.assertEquals(dict(name = 'Sally'), p1.__dict__)
-            self.assertEquals(dict(name = 'Fred', age = 37), p2.__dict__)
-        self.assertEquals(dict(name = 'Joe'), p1.__dict__)
-        self.assertEquals(dict(name = 'Fred'), p2.__dict__)
+    def test_separate_groups(self):
+        (a, b) = (self.mock_fcn('a'), self.mock_fcn('b'))
+        with self.in_order():
+            a.expect(1)
+            a.expect(2)
+        with self.in_order():
+            b.expect(1)
+            b.expect(2)
+        b(1)
+        a(1)
+        b(2)
+        a(2)
 
-    def test_sleeper(self):
-        import time
-        import os
-        sleep = self.mock_fcn("sleep").expect(10)
-        getpid = self.mock_fcn("getpid").expect().returns(1)
-        patches = self.patch_set(
-            (time, "sleep", sleep),
-            (os, "getpid", getpid)
+    def test_not_done(self):
+        (open_, read, close) = self.expect_pipeline(2)
+        open_('f')
+        self.assertEqual(3, self._context._pending_count())
+        self.assert_fails(
+            'Still expecting more function calls',
+            self._context.check_done
             )
-        with patches:
-            time.sleep(10)
-            self.assertEquals(1, os.getpid())
 
-    def test_no_such_attr(self):
-        x = self.mock_obj('x')
+    def test_needs_unordered(self):
+        context = CallContext()
         def should_raise():
-            x.foo
-        self.assertRaises(MockException, should_raise)
+            with context.in_order():
+                pass
+        self.assertRaises(Exception, should_raise)
 
-    def test_no_such_method(self):
-        x = self.mock_obj('x')
-        def should_raise():
-            x.foo()
-        self.assertRaises(MockException, should_raise)
+class Payload(bytearray):
 
-    def test_call_history(self):
-        double = self.mock_fcn('double')
-        car = self.mock_obj('car', ['drive', 'stop'])
-        car.drive.expect('60mph').returns(True)
-        double.expect(2).returns(4)
-        car.stop.expect().raises(OSError('ack'))
-        car.drive('60mph')
+    """
+    A bytearray that can be weakly referenced, for TestFingerprint.
+    """
+
+class TestFingerprint(TestCase):
+
+    fingerprint_call_history = True
+
+    def test_released(self):
+        payload = Payload(b'x' * 1000000)
+        ref = weakref.ref(payload)
+        send = self.mock_fcn('send').expect(payload).returns(len(payload))
+        send(bytearray(b'x' * 1000000))
+        del payload
+        self.assertEqual(None, ref())
+
+    def test_message(self):
+        payload = b'\x01' * 100000
+        send = self.mock_fcn('send').expect(payload, 1).returns('ok')
+        send(payload, 1)
         try:
-            double(3)
+            send(b'', 2)
             self.fail('should have thrown')
         except MockException as e:
+            lines = str(e).split('\n')
+        self.assertEqual(
+            "send(<bytes len=100,000 crc32=%08x b'%s\\x...>, 1) returns 'ok'" %
+                (zlib.crc32(payload), '\\x01' * 9),
+            lines[3]
+            )
+
+    def test_fingerprint(self):
+        self.assertEqual('3', fingerprint(3))
+        self.assertEqual("'abc'", fingerprint('abc'))
+        text = 'a' * 100
+        self.assertEqual(
+            "<str len=100 hash=%016x '%s...>" % (
+                hash(text) & 0xffffffffffffffff, 'a' * 39
+                ),
+            fingerprint(text)
+            )
+        self.assertEqual(
+            '<list len=100 [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, ...>',
+            fingerprint([0] * 100)
+            )
+
+    def test_repeated(self):
+        poll = self.mock_fcn('poll').expect().times(3)
+        poll()
+        poll()
+        self.assertEqual('poll() [3 times]', self._context._completed_calls[0])
+        poll()
+
+    def test_mocked_len(self):
+        for thread_safe in [False, True]:
+            context = CallContext(
+                thread_safe = thread_safe,
+                fingerprint_history = True
+                )
+            coll = MockObject(context, 'coll', ['__len__', '__hash__'])
+            fcn = MockFunction(context, 'f').expect(coll).returns(1)
+            coll.__len__.expect().returns(100)
+            self.assertEqual(1, fcn(coll))
+            self.assertEqual(100, len(coll))
+            context.check_done()
             self.assertEqual(
-                "Argument mismatch\n\nCompleted calls:\ncar.drive('60mph') returns True\n\nActual call:\ndouble(3)\n\nExpected calls:\ndouble(2) returns 4\ncar.stop() raises OSError('ack',)",
-                e.message
+                ['f(<MockObject coll>) returns 1', 'coll.__len__() returns 100'],
+                list(context._completed_calls)
                 )
 
-    def test_mock_obj_as_arg(self):
-        screw = self.mock_obj('screw')
-        nail = self.mock_obj('nail')
-        hammer = self.mock_obj('hammer', ['pound'])
-        hammer.pound.expect(nail)
-        hammer.pound.expect(nail)
-        hammer.pound(nail)
+class TestThreadSafe(TestCase):
+
+    call_ordering = PER_FUNCTION
+    thread_safe_calls = True
+
+    def run_threads(self, target, count):
+        threads = [
+            threading.Thread(target = target, args = (i,))
+            for i in range(count)
+            ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_independent_mocks(self):
+        fcns = [self.mock_fcn('f%d' % i) for i in range(8)]
+        for fcn in fcns:
+            for j in range(1000):
+                fcn.expect(j).returns(j)
+        results = [None] * len(fcns)
+        def worker(i):
+            results[i] = [fcns[i](j) for j in range(1000)]
+        self.run_threads(worker, len(fcns))
+        self.assertEqual([list(range(1000))] * len(fcns), results)
+
+    def test_shared_mock(self):
+        fcn = self.mock_fcn('f').expect().times(8000)
+        def worker(i):
+            for j in range(1000):
+                fcn()
+        self.run_threads(worker, 8)
+
+    def test_ordered(self):
+        context = CallContext(thread_safe = True)
+        fcn = MockFunction(context, 'f').expect().times(8000)
+        def worker(i):
+            for j in range(1000):
+                fcn()
+        self.run_threads(worker, 8)
+        context.check_done()
+
+    def test_failure_on_worker(self):
+        fcn = self.mock_fcn('f').expect(1)
+        def worker(i):
+            try:
+                fcn(2)
+            except MockException:
+                pass
+        self.run_threads(worker, 1)
         try:
-            hammer.pound(screw)
+            self._context.check_done()
             self.fail('should have thrown')
         except MockException as e:
-            self.assertEqual(
-                'Argument mismatch\n\nCompleted calls:\nhammer.pound(<MockObject nail>)\n\nActual call:\nhammer.pound(<MockObject screw>)\n\nExpected calls:\nhammer.pound(<MockObject nail>)',
-                e.message
-                )
+            self.assertEqual('Argument mismatch', e.args[0])
+        self._context.check_done()
+
+    def test_failures_while_matching(self):
+        # One thread fails over and over, resetting the pending calls,
+        # while the others keep adding and using up calls to their own
+        # functions, which adds and drops their queues.
+        workers = [
+            [self.mock_fcn('f%d_%d' % (i, j)) for j in range(50)]
+            for i in range(4)
+            ]
+        bad = self.mock_fcn('bad')
+        errors = []
+        def worker(i):
+            try:
+                if i == len(workers):
+                    for j in range(5000):
+                        self.assertRaises(MockException, bad, j)
+                    return
+                for j in range(300):
+                    for fcn in workers[i]:
+                        fcn.expect(j)
+                    for fcn in workers[i]:
+                        try:
+                            fcn(j)
+                        except MockException:
+                            # A reset took away the expected call.
+                            pass
+            except Exception as e:
+                errors.append(e)
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            self.run_threads(worker, len(workers) + 1)
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual([], errors)
+        self.assertRaises(MockException, self._context.check_done)
+        self._context = CallContext()
+
+    def test_reset_while_matching(self):
+        # A failure on one thread resets the pending calls while
+        # another thread is removing a matched call of its function.
+        fcn = self.mock_fcn('f').expect(1)
+        queue = self._context._pending[fcn]
+        self.assertRaises(MockException, self.mock_fcn('g'), 2)
+        fcn.expect(3)
+        self._context._remove_indexed(fcn, queue, 0)
+        fcn(3)
+
+class Account(object):
+
+    """
+    A real class for TestSpec to make mocks of.
+    """
+
+    interest_rate = 0.01
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def deposit(self, amount, memo = None):
+        pass
+
+    async def fetch_balance(self):
+        pass
+
+    @staticmethod
+    def parse(text):
+        pass
+
+    @classmethod
+    def open(cls, owner, *, joint = False):
+        pass
+
+    def __len__(self):
+        return 0
+
+    def _private(self):
+        pass
+
+class TestScript(TestCase):
+
+    def make_script(self):
+        script = ExpectationScript('prelude')
+        connect = script.mock_fcn('connect')
+        auth = script.mock_fcn('auth')
+        self.token = AnyValue()
+        connect.expect('host').returns('conn')
+        auth.expect('conn', self.token).returns(True)
+        connect.expect('ping').times(3)
+        return (script, connect, auth)
+
+    def run_prelude(self, connect, auth, token):
+        self.assertEqual('conn', connect('host'))
+        self.assertTrue(auth('conn', token))
+        for i in range(3):
+            connect('ping')
+
+    def test_bind(self):
+        (script, connect, auth) = self.make_script()
+        binding = self.bind_script(script)
+        connect.expect('close')
+        self.run_prelude(connect, auth, 'secret')
+        connect('close')
+        self.assertEqual('secret', binding.value(self.token))
+
+    def test_isolated(self):
+        (script, connect, auth) = self.make_script()
+        first = CallContext()
+        first_binding = script.bind(first)
+        self.run_prelude(connect, auth, 'a')
+        first.check_done()
+        second = CallContext()
+        second_binding = script.bind(second)
+        self.run_prelude(connect, auth, 'b')
+        second.check_done()
+        self.assertEqual('a', first_binding.value(self.token))
+        self.assertEqual('b', second_binding.value(self.token))
+        self.assertEqual(None, self.token.value)
+
+    def test_calls_shared(self):
+        (script, connect, auth) = self.make_script()
+        first = CallContext()
+        script.bind(first)
+        call = first._calls[0]
+        second = CallContext()
+        script.bind(second)
+        self.assertTrue(call is second._calls[0])
+        self.assertEqual(0, call.call_count)
+
+    def test_not_finished(self):
+        (script, connect, auth) = self.make_script()
+        context = CallContext()
+        script.bind(context)
+        connect('host')
+        try:
+            context.check_done()
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertTrue("more calls from script prelude" in str(e))
+
+    def test_per_function(self):
+        (script, connect, auth) = self.make_script()
+        context = CallContext(ordering = PER_FUNCTION)
+        binding = script.bind(context)
+        self.assertTrue(auth('conn', 'x'))
+        connect('host')
+        for i in range(3):
+            connect('ping')
+        context.check_done()
+        self.assertEqual('x', binding.value(self.token))
+
+    def test_unordered(self):
+        script = ExpectationScript()
+        get = script.mock_fcn('get')
+        get.expect('a').returns(1)
+        get.expect('b').returns(2)
+        token = AnyValue()
+        get.expect(token).returns(3)
+        context = CallContext(ordering = UNORDERED)
+        binding = script.bind(context)
+        self.assertEqual(2, get('b'))
+        self.assertEqual(3, get('c'))
+        self.assertEqual(1, get('a'))
+        context.check_done()
+        self.assertEqual('c', binding.value(token))
+
+    def test_frozen(self):
+        (script, connect, auth) = self.make_script()
+        self.bind_script(script)
+        self.assertRaises(Exception, script.mock_fcn, 'other')
+        self.run_prelude(connect, auth, 'x')
+
+class PatchTarget(object):
+
+    """
+    Holds the fields that TestClassPatches patches.
+    """
+
+    value = 'original'
+    hook = None
+
+class TestClassPatches(TestCase):
+
+    class_patches = [
+        (PatchTarget, 'value', 'patched'),
+        (PatchTarget, 'hook', len),
+        (PatchTarget, 'added', 1)
+        ]
+
+    def test_applied(self):
+        self.assertEqual('patched', PatchTarget.value)
+        self.assertEqual(3, PatchTarget.hook('abc'))
+        self.assertEqual(1, PatchTarget.added)
+
+    def test_restored(self):
+        class Target(object):
+            value = 'original'
+            hook = None
+        seen = []
+        class Inner(TestCase):
+            class_patches = [
+                (Target, 'value', 'patched'),
+                (Target, 'hook', len),
+                (Target, 'added', 1)
+                ]
+            def test_one(self):
+                seen.append(Target.value)
+            def test_two(self):
+                seen.append(Target.value)
+        suite = unittest.TestSuite([Inner('test_one'), Inner('test_two')])
+        result = unittest.TestResult()
+        suite.run(result)
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual(['patched', 'patched'], seen)
+        self.assertEqual('original', Target.value)
+        self.assertEqual(None, Target.__dict__['hook'])
+        self.assertFalse(hasattr(Target, 'added'))
+
+    def test_module_patches(self):
+        class Target(object):
+            value = None
+        (set_up, tear_down) = module_patches((Target, 'value', 1))
+        set_up()
+        self.assertEqual(1, Target.value)
+        tear_down()
+        self.assertEqual(None, Target.__dict__['value'])
+
+class TestSpec(TestCase):
+
+    def test_methods(self):
+        account = self.mock_spec('account', Account)
+        account.deposit.expect(10, memo = 'pay').returns(True)
+        account.parse.expect('x').returns(1)
+        account.open.expect('me', joint = True)
+        self.assertTrue(account.deposit(10, memo = 'pay'))
+        self.assertEqual(1, account.parse('x'))
+        account.open('me', joint = True)
+
+    def test_members(self):
+        account = self.mock_spec('account', Account, interest_rate = 0.5)
+        self.assertEqual(0.5, account.interest_rate)
+        self.assertTrue(hasattr(account, '__len__'))
+        self.assertFalse(hasattr(account, '__iter__'))
+        self.assertRaises(MockException, getattr, account, '_private')
+        self.assertRaises(MockException, getattr, account, 'withdraw')
+        account.__len__.expect().returns(3)
+        self.assertEqual(3, len(account))
+
+    def test_bad_expect(self):
+        account = self.mock_spec('account', Account)
+        self.assertRaises(TypeError, account.deposit.expect)
+        self.assertRaises(TypeError, account.deposit.expect, 1, 2, 3)
+        self.assertRaises(TypeError, account.open.expect, 'me', True)
+
+    def test_bad_call(self):
+        account = self.mock_spec('account', Account)
+        account.deposit.expect(10)
+        def should_raise():
+            try:
+                account.deposit(10, note = 'x')
+            except TypeError:
+                pass
+        try:
+            should_raise()
+            self.fail('should have thrown')
+        except MockException as e:
+            self.assertTrue(e.args[0].startswith(
+                'Signature mismatch for account.deposit(amount, memo=None)'
+                ))
+
+    def test_async(self):
+        account = self.mock_spec('account', Account)
+        self.assertTrue(isinstance(account.fetch_balance, AsyncMockFunction))
+        account.fetch_balance.expect().returns(5).delays(1)
+        self.assertEqual(5, self.run_async(account.fetch_balance()))
+        self.assertRaises(TypeError, account.fetch_balance.expect, 1)
+
+    def test_module(self):
+        fake = self.mock_spec('inspect', inspect)
+        fake.getdoc.expect(Account).returns('doc')
+        self.assertEqual('doc', fake.getdoc(Account))
+        self.assertRaises(TypeError, fake.getdoc.expect, 1, 2)
+
+    def test_cached(self):
+        members = spec_members(Account)
+        self.assertTrue(members is spec_members(Account))
+        self.assertEqual(
+            ['__len__', 'deposit', 'fetch_balance', 'open', 'parse'],
+            [name for (name, mock_class, checker) in members]
+            )
+
+    def test_not_a_spec(self):
+        self.assertRaises(TypeError, self.mock_spec, 'x', Account('me'))
 
 if __name__ == '__main__':
     unittest.main()